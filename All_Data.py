@@ -1,50 +1,318 @@
 # All_Data.py (override-only for *_Larg* + presort exclusivity + strong normalization)
 # -*- coding: utf-8 -*-
-import os, json, sys, re, unicodedata
+import os, json, sys, re, unicodedata, time, atexit, hashlib
+import cProfile, pstats, tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import zip_longest, islice, chain
+from operator import itemgetter
 import gspread
-from google.oauth2.service_account import Credentials
+from gspread.utils import rowcol_to_a1
+from common import (
+    HEADERS, RECORDS_PATH, RULES_TAB, SCOPES, SPREADSHEET_ID, SHEETS_EMULATOR_URL,
+    service_account_client, emulator_client, norm_str, norm_name, norm_task, base_task,
+    norm_date_str, norm_hour_key, _parse_excel_serial, dedup_keys_for_rows,
+    DateParser, DEFAULT_DATE_PARSER, KeyStore, SnapshotStore, ArchiveStore, archive_fps,
+    delete_sheet_rows, PrefixRules,
+)
 
 # ---------------------------
 # تنظیمات
 # ---------------------------
-SCOPES = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive",
-]
-SPREADSHEET_ID = os.getenv(
-    "SPREADSHEET_ID",
-    "1VgKCQ8EjVF2sS8rSPdqFZh2h6CuqWAeqSMR56APvwes"
-)
+# SCOPES / SPREADSHEET_ID / SHEETS_EMULATOR_URL در common.py (مشترک با backfill.py)
 
-# حداقل مقدار معتبر برای ثبت خروجی‌ها
+# حداقل مقدار معتبر برای ثبت خروجی‌ها (وقتی قوانین فیلتر برای tab/task حداقل دیگری نداده‌اند)
 try:
     MIN_QTY_OUT = int(os.getenv("MIN_QTY_OUT", "15"))
 except:
     MIN_QTY_OUT = 15
 
+# قوانین فیلتر: فایل JSON در RULES_PATH، وگرنه تب RULES_TAB (اگر باشد)، وگرنه قوانین پیش‌فرض
+RULES_PATH = os.getenv("RULES_PATH", "").strip()
+
 # نمایش پرفورمنس به صورت درصد با علامت %
 PERF_AS_PERCENT = True
 
+# خروجی ستونی برای تحلیل (خالی = غیرفعال) ؛ EXPORT_FORMAT: parquet | arrow
+EXPORT_DIR = os.getenv("EXPORT_DIR", "").strip()
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "parquet").strip().lower()
+
+# تب خلاصه (person × date × task_type × Shift) که هر اجرا فقط با ردیف‌های جدید به‌روز می‌شود (خالی = غیرفعال)
+ROLLUP_TAB = os.getenv("ROLLUP_TAB", "").strip()
+
+# فایل آمار اجرا (web.py برای هر اجرا تنظیمش می‌کند؛ خالی = ذخیره نشود)
+RUN_STATS_PATH = os.getenv("RUN_STATS_PATH", "").strip()
+# رویدادهای پیشرفت اجرا (JSON در هر خط) برای استریم SSE در web.py (خالی = غیرفعال)
+RUN_EVENTS_PATH = os.getenv("RUN_EVENTS_PATH", "").strip()
+
+# ساخت موازی کلیدهای dedup از All_Data در حالت set (KEYS_WORKERS<=1 = سریال، پیش‌فرض؛ README را ببینید)
+try:
+    KEYS_WORKERS = int(os.getenv("KEYS_WORKERS", "0"))
+except:
+    KEYS_WORKERS = 0
+# اندازهٔ تکه‌ها برای worker ها و هنگام ایندکس کردن ردیف‌های All_Data در حالت bloom
+try:
+    KEYS_CHUNK_ROWS = max(1000, int(os.getenv("KEYS_CHUNK_ROWS", "20000")))
+except:
+    KEYS_CHUNK_ROWS = 20000
+
+# فقط ستون‌های مورد استفاده از تب‌های ورودی خوانده شود (0 = get_all_values کامل)
+PROJECTED_READS = os.getenv("PROJECTED_READS", "1").strip() not in ("0", "false", "no", "")
+
+# خواندن مقادیر تایپ‌شده از تب‌های ورودی (UNFORMATTED_VALUE + SERIAL_NUMBER):
+# تاریخ/ساعت به صورت عدد سریال و اعداد به صورت number می‌رسند و parse رشته‌ای حذف می‌شود
+TYPED_READS = os.getenv("TYPED_READS", "0").strip() not in ("0", "false", "no", "")
+
+# تب‌های ورودی صفحه‌به‌صفحه (READ_PAGE_ROWS ردیف در هر درخواست) خوانده می‌شوند و صفحهٔ بعد
+# هم‌زمان با parse صفحهٔ فعلی گرفته می‌شود (0 = کل تب در یک درخواست)
+try:
+    READ_PAGE_ROWS = max(0, int(os.getenv("READ_PAGE_ROWS", "10000")))
+except:
+    READ_PAGE_ROWS = 10000
+
+# ژورنال write-ahead برای append نهایی (خالی = غیرفعال)
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "/tmp/all_data_journal.jsonl").strip()
+
+# پروفایل اجرا (cProfile + tracemalloc) در این پوشه (web.py با /run?profile=1 تنظیمش می‌کند)
+RUN_PROFILE_DIR = os.getenv("RUN_PROFILE_DIR", "").strip()
+try:
+    PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+except:
+    PROFILE_TOP_N = 25
+
+# حالت dedup: set (همه کلیدها در حافظه) | bloom (Bloom filter پایدار + ایندکس دقیق روی دیسک)
+DEDUP_MODE = os.getenv("DEDUP_MODE", "set").strip().lower()
+DEDUP_DIR = os.getenv("DEDUP_DIR", "/tmp/all_data_dedup").strip()
+try:
+    DEDUP_BLOOM_CAPACITY = int(os.getenv("DEDUP_BLOOM_CAPACITY", "5000000"))
+except:
+    DEDUP_BLOOM_CAPACITY = 5000000
+
+# بازمحاسبهٔ پرفورمنس ردیف‌های قبلی All_Data وقتی KPI_Config تغییر کند (off | auto ؛ پیش‌فرض off)
+KPI_BACKFILL = os.getenv("KPI_BACKFILL", "off").strip().lower()
+KPI_STATE_PATH = os.getenv("KPI_STATE_PATH", "/tmp/all_data_kpi_state.json").strip()
+KPI_BACKFILL_BATCH = 500   # range در هر values.batchUpdate
+
+# حداکثر ردیف در هر append به All_Data
+try:
+    APPEND_CHUNK_ROWS = max(1, int(os.getenv("APPEND_CHUNK_ROWS", "5000")))
+except:
+    APPEND_CHUNK_ROWS = 5000
+
+# مجموع ساعتی Pick/Presort بین اجراها نگه داشته می‌شود تا فقط ردیف‌های جدید خوانده و جمع شوند
+# (پیش‌فرض خالی = هر بار کل تب‌ها، مثل قبل). ساعت‌های قدیمی‌تر از HOUR_BUCKET_DAYS نگه داشته نمی‌شوند.
+HOUR_BUCKETS_PATH = os.getenv("HOUR_BUCKETS_PATH", "").strip()
+try:
+    HOUR_BUCKET_DAYS = max(1, int(os.getenv("HOUR_BUCKET_DAYS", "7")))
+except:
+    HOUR_BUCKET_DAYS = 7
+
+# snapshot فشرده از گرید خام تب‌های ورودی در هر اجرا (خالی = غیرفعال)؛ SNAPSHOT_KEEP اجرای آخر نگه داشته می‌شود
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "").strip()
+try:
+    SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "50"))
+except:
+    SNAPSHOT_KEEP = 50
+
+# بایگانی ردیف‌های پردازش‌شدهٔ تب‌های ورودی که از ARCHIVE_DAYS روز قدیمی‌ترند (0 = غیرفعال).
+# ARCHIVE_TARGET: tabs = تب ماهانهٔ "<tab> Archive YYYY-MM" در همین spreadsheet، local = ARCHIVE_DIR
+try:
+    ARCHIVE_DAYS = max(0, int(os.getenv("ARCHIVE_DAYS", "0")))
+except:
+    ARCHIVE_DAYS = 0
+ARCHIVE_TARGET = os.getenv("ARCHIVE_TARGET", "tabs").strip().lower()
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/tmp/all_data_archive")
+ARCHIVE_JOURNAL_PATH = os.getenv("ARCHIVE_JOURNAL_PATH", "/tmp/all_data_archive_journal.json")
+
+# خطاهای ردیفی: فقط چند مورد اول هر (تب × نوع خطا) چاپ و نمونه‌برداری می‌شود، بقیه فقط شمرده می‌شوند
+try:
+    ERROR_PRINT_LIMIT = max(0, int(os.getenv("ERROR_PRINT_LIMIT", "3")))
+except:
+    ERROR_PRINT_LIMIT = 3
+try:
+    ERROR_SAMPLES = max(0, int(os.getenv("ERROR_SAMPLES", "5")))
+except:
+    ERROR_SAMPLES = 5
+
+# ---------------------------
+# آمار اجرا: زمان هر مرحله، ردیف‌های خوانده/ثبت/رد شده، تعداد فراخوانی API
+# ---------------------------
+run_stats = {
+    "started_at": time.time(),
+    "stages": {},                       # stage -> seconds
+    "rows_read": {},                    # tab -> data rows
+    "rows_emitted": {},                 # task_type -> rows
+    "rows_dropped": defaultdict(int),   # "tab:reason" -> rows
+    "api_calls": defaultdict(int),      # HTTP method / "429" -> calls
+    "errors": {},                       # "tab:ErrorClass" -> {"count", "samples"}
+}
+_stage = {"name": "connect", "t0": time.perf_counter()}
+_events_file = None
+_profiler = None
+_alloc = {"snap": None, "stages": []}   # stage -> top allocations made during it
+
+def emit_event(kind, **fields):
+    global _events_file
+    if not RUN_EVENTS_PATH:
+        return
+    try:
+        if _events_file is None:
+            _events_file = open(RUN_EVENTS_PATH, "a", encoding="utf-8", buffering=1)
+        fields.update({"event": kind, "ts": round(time.time(), 3)})
+        _events_file.write(json.dumps(fields, ensure_ascii=False) + "\n")
+    except Exception:
+        pass
+
+def mark_stage(name):
+    now = time.perf_counter()
+    prev = _stage["name"]
+    run_stats["stages"][prev] = run_stats["stages"].get(prev, 0.0) + (now - _stage["t0"])
+    _stage["name"], _stage["t0"] = name, now
+    emit_event("stage", stage=name, previous=prev, previous_s=round(run_stats["stages"][prev], 3))
+    _alloc_checkpoint(prev)
+
+def _alloc_checkpoint(stage):
+    if _profiler is None:
+        return
+    _profiler.disable()  # زمان snapshot در پروفایل CPU حساب نشود
+    snap = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    prev = _alloc["snap"]
+    top = snap.compare_to(prev, "lineno") if prev else snap.statistics("lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    _alloc["stages"].append({
+        "stage": stage,
+        "current_mb": round(current / 1e6, 2),
+        "peak_mb": round(peak / 1e6, 2),
+        "top": [str(s) for s in top[:PROFILE_TOP_N]],
+    })
+    _alloc["snap"] = snap
+    _profiler.enable()
+
+def _drop(tab, reason):
+    run_stats["rows_dropped"][f"{tab}:{reason}"] += 1
+
+def report_error(tab, e, row=None):
+    """
+    Counts a row-level error under tab × exception class. Only the first
+    ERROR_PRINT_LIMIT of each class are printed; ERROR_SAMPLES keep the row.
+    """
+    key = f"{tab}:{type(e).__name__}"
+    ent = run_stats["errors"].get(key)
+    if ent is None:
+        ent = run_stats["errors"][key] = {"count": 0, "samples": []}
+        emit_event("error_class", tab=tab, error=type(e).__name__, message=str(e)[:300])
+    ent["count"] += 1
+    if len(ent["samples"]) < ERROR_SAMPLES:
+        ent["samples"].append({
+            "message": str(e)[:300],
+            "row": [norm_str(v)[:100] for v in row][:20] if row is not None else None,
+        })
+    if ent["count"] <= ERROR_PRINT_LIMIT:
+        print(f"❌ Error in {tab}: {e}")
+        if ent["count"] == ERROR_PRINT_LIMIT:
+            print(f"ℹ️ Further {type(e).__name__} errors in {tab} are only counted.")
+
+def print_error_summary():
+    errors = run_stats["errors"]
+    if not errors:
+        return
+    total = sum(ent["count"] for ent in errors.values())
+    top = sorted(errors.items(), key=lambda kv: kv[1]["count"], reverse=True)
+    print(f"⚠️ {total} row errors: " + ", ".join(f"{k} ×{ent['count']}" for k, ent in top[:10]))
+
+def _count_api_call(resp, *args, **kwargs):
+    run_stats["api_calls"][resp.request.method] += 1
+    if resp.status_code == 429:
+        run_stats["api_calls"]["429"] += 1
+        emit_event("quota_wait", url=resp.request.url.split("?")[0], retry_after=resp.headers.get("Retry-After"))
+
+def _write_run_stats():
+    mark_stage("done")
+    if not RUN_STATS_PATH:
+        return
+    try:
+        run_stats["ended_at"] = time.time()
+        tmp = RUN_STATS_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(run_stats, f, ensure_ascii=False)
+        os.replace(tmp, RUN_STATS_PATH)
+    except Exception as e:
+        print(f"❌ Run stats error: {e}")
+
+def _write_profile():
+    """
+    RUN_PROFILE_DIR/run.pstats, alloc.txt (top-N allocations per stage) and
+    summary.json (hottest functions + per-stage memory) for web.py.
+    """
+    if _profiler is None:
+        return
+    try:
+        _profiler.disable()
+        os.makedirs(RUN_PROFILE_DIR, exist_ok=True)
+        _profiler.dump_stats(os.path.join(RUN_PROFILE_DIR, "run.pstats"))
+
+        with open(os.path.join(RUN_PROFILE_DIR, "alloc.txt"), "w", encoding="utf-8") as f:
+            for st in _alloc["stages"]:
+                f.write(f"== {st['stage']} (current {st['current_mb']} MB, peak {st['peak_mb']} MB)\n")
+                f.writelines(line + "\n" for line in st["top"])
+                f.write("\n")
+
+        def top_by(i):
+            rows = sorted(pstats.Stats(_profiler).stats.items(), key=lambda kv: kv[1][i], reverse=True)
+            return [{
+                "function": f"{os.path.basename(fn)}:{line}({name})",
+                "calls": nc,
+                "tottime": round(tt, 4),
+                "cumtime": round(ct, 4),
+            } for (fn, line, name), (cc, nc, tt, ct, _) in rows[:PROFILE_TOP_N]]
+
+        summary = {
+            "top_cumulative": top_by(3),
+            "top_tottime": top_by(2),
+            "memory": [{k: st[k] for k in ("stage", "current_mb", "peak_mb")} for st in _alloc["stages"]],
+        }
+        with open(os.path.join(RUN_PROFILE_DIR, "summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False)
+        tracemalloc.stop()
+    except Exception as e:
+        print(f"❌ Profile write error: {e}")
+
+def _on_exit():
+    _write_run_stats()
+    _write_profile()
+
+atexit.register(_on_exit)
+
+if RUN_PROFILE_DIR:
+    tracemalloc.start()
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
 # ---------------------------
 # اتصال
 # ---------------------------
 def make_client():
-    env_creds = os.getenv("GOOGLE_CREDENTIALS")
+    if SHEETS_EMULATOR_URL:
+        print(f"ℹ️ Using Sheets emulator at {SHEETS_EMULATOR_URL}.")
+        return emulator_client(SHEETS_EMULATOR_URL)
     try:
-        if env_creds:
-            creds = Credentials.from_service_account_info(json.loads(env_creds), scopes=SCOPES)
+        gc = service_account_client(SCOPES)
+        if os.getenv("GOOGLE_CREDENTIALS"):
             print("Auth via GOOGLE_CREDENTIALS (ENV).")
         else:
-            creds = Credentials.from_service_account_file("credentials.json", scopes=SCOPES)
             print("Auth via credentials.json (file).")
-        return gspread.authorize(creds)
+        return gc
     except Exception as e:
         print(f"❌ Auth error: {e}")
         sys.exit(1)
 
 gc = make_client()
+# شمارش درخواست‌های HTTP از طریق hook جلسهٔ requests (gspread 5: gc.session ، gspread 6: gc.http_client.session)
+_session = getattr(getattr(gc, "http_client", gc), "session", None)
+if _session is not None:
+    _session.hooks["response"].append(_count_api_call)
 try:
     ss = gc.open_by_key(SPREADSHEET_ID)
     print(f"✅ Opened spreadsheet {SPREADSHEET_ID}.")
@@ -55,9 +323,6 @@ except Exception as e:
 # ---------------------------
 # Helpers
 # ---------------------------
-def norm_str(x):
-    return "" if x is None else str(x).strip()
-
 def norm_num(x):
     if x is None or x == "":
         return ""
@@ -67,39 +332,22 @@ def norm_num(x):
     except:
         return norm_str(x)
 
-def norm_date_str(dt):
-    if dt is None or dt == "":
-        return ""
-    if hasattr(dt, "strftime"):
-        return dt.strftime("%Y-%m-%d")
-    s = str(dt).strip()
-    for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%B %d, %Y", "%m/%d/%Y %H:%M:%S"):
-        try:
-            return datetime.strptime(s, fmt).strftime("%Y-%m-%d")
-        except:
-            pass
-    return s
-
-def _parse_excel_serial(val):
-    return datetime(1899, 12, 30) + timedelta(days=float(val))
-
-def parse_date_hour(date_raw, hour_raw):
+def parse_date_hour(date_raw, hour_raw, date_parser, tab):
+    """-> (datetime | None, hour | None); a parse error is counted under `tab`, the caller's source tab"""
     record_date, hour_val = None, None
     try:
         # تاریخ
         if isinstance(date_raw, (int, float)) and float(date_raw) > 30000:
             record_date = _parse_excel_serial(date_raw)
         elif isinstance(date_raw, str) and date_raw:
-            for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%B %d, %Y", "%m/%d/%Y %H:%M:%S"):
-                try:
-                    record_date = datetime.strptime(date_raw.strip(), fmt)
-                    break
-                except:
-                    continue
+            record_date = (date_parser or DEFAULT_DATE_PARSER).parse(date_raw)
         # ساعت
         if isinstance(hour_raw, (int, float)):
             f = float(hour_raw)
-            if 0 <= int(f) <= 23:
+            if 0 < f < 1:
+                # مقدار زمان تایپ‌شده (کسری از روز)، مثل 0.375 = 09:00
+                hour_val = _parse_excel_serial(f).hour
+            elif 0 <= int(f) <= 23:
                 hour_val = int(f)
             else:
                 hour_val = _parse_excel_serial(f).hour
@@ -115,7 +363,7 @@ def parse_date_hour(date_raw, hour_raw):
                 except:
                     pass
     except Exception as e:
-        print(f"❌ Error parsing date/hour: {e}")
+        report_error(tab, e, (date_raw, hour_raw))
     return record_date, hour_val
 
 def parse_date_only(x):
@@ -124,11 +372,9 @@ def parse_date_only(x):
     if isinstance(x, (int, float)) and float(x) > 30000:
         return _parse_excel_serial(x).date()
     if isinstance(x, str):
-        for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%B %d, %Y", "%m/%d/%Y %H:%M:%S"):
-            try:
-                return datetime.strptime(x.strip(), fmt).date()
-            except:
-                continue
+        dt = DEFAULT_DATE_PARSER.parse(x)
+        if dt:
+            return dt.date()
         try:
             f = float(x)
             if f > 30000:
@@ -137,54 +383,10 @@ def parse_date_only(x):
             pass
     return None
 
-# ----- Regex sets for normalization -----
-_ZW_RE = re.compile(r"[\u200c\u200d\u200e\u200f\u202a-\u202e\u2066-\u2069\u061c\uFEFF]")
-_ARABIC_DIAC = re.compile(r"[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]")
-
-def norm_name(s: str) -> str:
-    if s is None:
-        return ""
-    s = unicodedata.normalize("NFKC", str(s))
-    s = s.replace("ي", "ی").replace("ى", "ی").replace("ې", "ی").replace("ك", "ک")
-    s = _ZW_RE.sub("", s)
-    s = _ARABIC_DIAC.sub("", s)
-    s = s.replace("\u200c", " ")
-    s = s.replace("\u00A0", " ").replace("\t", " ").replace("\r", " ").replace("\n", " ")
-    s = s.replace("\u0640", "")
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
-def norm_task(s: str) -> str:
-    if s is None:
-        return ""
-    s = unicodedata.normalize("NFKC", str(s))
-    s = _ZW_RE.sub("", s)
-    s = s.replace("\u0640", "")
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
-
-def norm_hour_key(x):
-    if x is None or x == "":
-        return ""
-    try:
-        f = float(x)
-        i = int(f)
-        if 0 <= i <= 23:
-            return str(i)
-        return str(_parse_excel_serial(f).hour)
-    except:
-        s = str(x).strip()
-        if s.isdigit():
-            return s
-        try:
-            return str(_parse_excel_serial(float(s)).hour)
-        except:
-            return s
-
 def shift_from_username(user):
     s = "Other"
     if user:
-        lower = user.lower().strip()
+        lower = str(user).lower().strip()
         if lower.endswith(".s1"):
             s = "Shift1"
         elif lower.endswith(".s2"):
@@ -195,25 +397,6 @@ def shift_from_username(user):
             s = "Flex"
     return s
 
-# --- NEW: Receive center filter ---
-def is_allowed_receive_center(center_raw: str) -> bool:
-    """
-    Only allow centers whose name starts with:
-      - 'مرکز پردازش مهرآباد'
-      - 'هاب گنجه'
-    Drop anything that starts with 'هاب' but is not 'هاب گنجه'.
-    """
-    c = norm_name(center_raw)
-    if not c:
-        return False
-    if c.startswith("مرکز پردازش مهرآباد"):
-        return True
-    if c.startswith("هاب گنجه"):
-        return True
-    if c.startswith("هاب"):
-        return False
-    return False  # only the two above are allowed
-
 # ---------------------------
 # Sheets
 # ---------------------------
@@ -225,44 +408,347 @@ try:
 except:
     ws_override = None
 
-HEADERS = [
-    'full_name','task_type','quantity','date','hour','occupied_hours','order',
-    'performance_without_rotation','performance_with_rotation','Negative_Minutes',
-    'Ipo_Pack','UserName','Shift'
-]
-vals_all = ws_all.get_all_values()
-if not vals_all:
-    ws_all.append_row(HEADERS)
-    vals_all = [HEADERS]
-else:
-    if vals_all[0] != HEADERS:
+# ---------------------------
+# Snapshot تب‌های ورودی (همان گریدی که pipeline خوانده) برای اجرای دوباره با sheets_emulator.py
+# ---------------------------
+snapshots, _snapshot_prev, _snapshot_tabs = None, {}, {}
+if SNAPSHOT_DIR:
+    try:
+        snapshots = SnapshotStore(SNAPSHOT_DIR)
+        if snapshots.manifest_ids():
+            _snapshot_prev = snapshots.manifest()["tabs"]
+    except Exception as e:
+        print(f"⚠️ Snapshot store unavailable ({e}); snapshots disabled.")
+        snapshots = None
+
+def snapshot_tab(title, grid, first_row=2):
+    """
+    Stores the grid read from a tab. A tail read (first_row > 2) is completed
+    with the rows above it from the previous snapshot when that one is complete.
+    """
+    if snapshots is None:
+        return
+    try:
+        if first_row > 2:
+            prev = _snapshot_prev.get(title)
+            if prev and not prev.get("first_row"):
+                # بعد از بایگانی، ردیف‌های بالای watermark همان گرید بعد از حذف هستند
+                base = snapshots.get(prev.get("after_archive") or prev["sha256"])
+            else:
+                base = None
+            if base and base[:1] == grid[:1] and len(base) >= first_row - 1:
+                grid = base[:first_row - 1] + grid[1:]
+                first_row = 2
+        sha, written = snapshots.put(grid)
+        entry = {"sha256": sha, "rows": max(len(grid) - 1, 0), "bytes": written}
+        if first_row > 2:
+            entry["first_row"] = first_row  # فقط ردیف‌های first_row به بعد
+        _snapshot_tabs[title] = entry
+    except Exception as e:
+        print(f"⚠️ Snapshot of '{title}' failed: {e}")
+
+def write_snapshot_manifest():
+    if snapshots is None or not _snapshot_tabs:
+        return
+    try:
+        sid = snapshots.save_manifest(_snapshot_tabs, spreadsheet=SPREADSHEET_ID,
+                                      projected=PROJECTED_READS, typed=TYPED_READS)
+        written = sum(e["bytes"] for e in _snapshot_tabs.values())
+        new = sum(1 for e in _snapshot_tabs.values() if e["bytes"])
+        run_stats["snapshot"] = {"id": sid, "tabs": len(_snapshot_tabs), "new_tabs": new, "bytes": written}
+        emit_event("snapshot", id=sid, tabs=len(_snapshot_tabs), new_tabs=new, bytes=written)
+        print(f"📸 Snapshot {sid}: {len(_snapshot_tabs)} tabs, {new} changed ({written / 1e6:.2f} MB).")
+        if SNAPSHOT_KEEP > 0:
+            snapshots.prune(SNAPSHOT_KEEP)
+    except Exception as e:
+        print(f"❌ Snapshot manifest error: {e}")
+
+atexit.register(write_snapshot_manifest)
+
+# ---------------------------
+# ژورنال write-ahead: batch محاسبه‌شده و وضعیت هر chunk قبل/بعد از نوشتن ثبت می‌شود.
+# اگر اجرای قبلی وسط append قطع شده باشد، همان batch تأیید/تکمیل می‌شود.
+# ردیف‌هایی که درجا بازنویسی می‌شوند (مجموع ساعتی / KPI) هم قبل از نوشتن ثبت می‌شوند و هر مرحلهٔ
+# بعدی (export / rollups / records_log) فقط بعد از موفقیت done می‌شود؛ ژورنال بعد از همهٔ مراحل پاک می‌شود.
+#   line 1: {"type": "batch", ...rows, "carry": {stage: rows}}
+#   سپس  {"type": "chunk", "n", "status": writing|committed} / {"type": "rows", "stage", "rows"} / {"type": "stage", "name"}
+# ---------------------------
+JOURNAL_STAGES = ("export", "rollups", "records_log")
+
+def _journal_append(obj):
+    with open(JOURNAL_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def journal_begin(rows, base_rows, chunk_rows, carry=None):
+    """carry: {stage: rows} still pending from the previous run's journal."""
+    if not JOURNAL_PATH:
+        return
+    tmp = JOURNAL_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "type": "batch", "spreadsheet": SPREADSHEET_ID, "created_at": time.time(),
+            "base_rows": base_rows, "chunk_rows": chunk_rows, "rows": rows, "carry": carry or {},
+        }, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, JOURNAL_PATH)
+
+def journal_mark(n, status):
+    if JOURNAL_PATH:
+        _journal_append({"type": "chunk", "n": n, "status": status})
+
+def journal_rows(stage, rows):
+    """Rows about to be rewritten in place; the downstream stages pick them up after a crash."""
+    if JOURNAL_PATH and rows:
+        _journal_append({"type": "rows", "stage": stage, "rows": rows})
+
+def journal_stage(name):
+    if JOURNAL_PATH:
+        _journal_append({"type": "stage", "name": name})
+
+def journal_done():
+    if JOURNAL_PATH and os.path.exists(JOURNAL_PATH):
+        os.remove(JOURNAL_PATH)
+
+def journal_load():
+    if not JOURNAL_PATH or not os.path.exists(JOURNAL_PATH):
+        return None, {}
+    batch, status, staged, done = None, {}, [], set()
+    with open(JOURNAL_PATH, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break  # آخرین خط نیمه‌کاره
+            if rec.get("type") == "batch":
+                batch = rec
+            elif rec.get("type") == "chunk":
+                status[rec["n"]] = rec["status"]
+            elif rec.get("type") == "rows":
+                staged.extend(rec["rows"])
+            elif rec.get("type") == "stage":
+                done.add(rec["name"])
+    if batch:
+        batch["staged"], batch["done"] = staged, done
+    return batch, status
+
+def _chunk_landed(first_row, chunk):
+    got = ws_all.get(f"A{first_row}:D{first_row + len(chunk) - 1}")
+    if len(got) != len(chunk):
+        return False
+    for have, want in zip(got, chunk):
+        have = list(have) + [""] * (4 - len(have))
+        if norm_name(have[0]) != norm_name(want[0]) or norm_str(have[3]) != norm_str(want[3]):
+            return False
+    return True
+
+def recover_journal():
+    """
+    Completes the interrupted batch (only chunks not confirmed committed) and returns
+    {stage: rows} for the downstream stages it never finished. A chunk marked
+    'writing' is first checked at its expected sheet position. Journals written
+    before stage markers existed replay every stage (they all recompute by date).
+    """
+    try:
+        batch, status = journal_load()
+    except Exception as e:
+        print(f"❌ Journal read error: {e}")
+        return {}
+    if not batch:
+        return {}
+    if batch.get("spreadsheet") != SPREADSHEET_ID:
+        print("⚠️ Journal belongs to another spreadsheet; ignored.")
+        journal_done()
+        return {}
+
+    rows, size = batch["rows"], max(1, int(batch["chunk_rows"]))
+    written = []
+    print(f"♻️ Recovering unfinished batch of {len(rows)} rows from journal.")
+    for n, i in enumerate(range(0, len(rows), size), start=1):
+        chunk = rows[i:i + size]
+        st = status.get(n)
+        if st == "committed":
+            continue
+        if st == "writing" and _chunk_landed(batch["base_rows"] + i + 1, chunk):
+            journal_mark(n, "committed")
+            emit_event("journal_chunk", chunk=n, status="confirmed")
+            continue
+        journal_mark(n, "writing")
+        ws_all.append_rows(chunk, value_input_option="RAW")
+        journal_mark(n, "committed")
+        emit_event("journal_chunk", chunk=n, status="replayed", rows=len(chunk))
+        written.extend(chunk)
+    carry = batch.get("carry") or {}
+    touched = rows + batch["staged"]
+    pending = {s: carry.get(s, []) + touched for s in JOURNAL_STAGES if s not in batch["done"]}
+    pending = {s: r for s, r in pending.items() if r}
+    print(f"♻️ Journal recovery done: {len(written)} rows replayed"
+          + (f", pending stages: {', '.join(pending)}." if pending else "."))
+    return pending
+
+mark_stage("recover")
+journal_carry = recover_journal()  # stage -> rows که export / rollups / records_log هنوز نگرفته‌اند
+
+mark_stage("read_all_data")
+
+def _pad_row(r, width=len(HEADERS)):
+    return list(r[:width]) + [""] * (width - len(r))
+
+def iter_all_data(first_row=2):
+    """All_Data rows (padded to HEADERS) from sheet row first_row on, KEYS_CHUNK_ROWS per request."""
+    while True:
+        page = ws_all.get(f"A{first_row}:M{first_row + KEYS_CHUNK_ROWS - 1}")
+        if not any(page):
+            return
+        for r in page:
+            yield _pad_row(r)
+        first_row += KEYS_CHUNK_ROWS
+
+def all_data_rows(want):
+    """
+    [(sheet row, row)] of the All_Data rows with want(task_type, date) true. In bloom
+    mode (no vals_all) only columns B and D are scanned, page by page, and then just
+    the matching rows are fetched as merged ranges.
+    """
+    if vals_all is not None:
+        return [(n, _pad_row(r)) for n, r in enumerate(vals_all[1:], start=2) if len(r) > 3 and want(r[1], r[3])]
+    hits = []
+    for a in range(2, all_data_count + 2, KEYS_CHUNK_ROWS):
+        b = min(a + KEYS_CHUNK_ROWS - 1, all_data_count + 1)
+        tasks, dates = ws_all.batch_get([f"B{a}:B{b}", f"D{a}:D{b}"])
+        for i in range(min(len(dates), b - a + 1)):
+            t = tasks[i][0] if i < len(tasks) and tasks[i] else ""
+            d = dates[i][0] if dates[i] else ""
+            if d and want(t, d):
+                hits.append(a + i)
+    spans = []
+    for n in hits:
+        if spans and spans[-1][1] == n - 1:
+            spans[-1][1] = n
+        else:
+            spans.append([n, n])
+    out = []
+    for i in range(0, len(spans), KPI_BACKFILL_BATCH):
+        group = spans[i:i + KPI_BACKFILL_BATCH]
+        for (a, b), vr in zip(group, ws_all.batch_get([f"A{a}:M{b}" for a, b in group])):
+            out.extend((a + k, _pad_row(r)) for k, r in enumerate(vr))
+    return out
+
+if DEDUP_MODE == "bloom":
+    # کل All_Data در حافظه خوانده نمی‌شود: فقط header؛ ردیف‌ها بازه‌ای/صفحه‌ای خوانده می‌شوند
+    vals_all = None
+    head = ws_all.row_values(1)
+    if not head:
+        ws_all.append_row(HEADERS)
+    elif head != HEADERS:
         ws_all.delete_rows(1)
         ws_all.insert_row(HEADERS, 1)
-        vals_all = ws_all.get_all_values()
+    all_data_count = 0  # در open_dedup_stores شمرده می‌شود
+else:
+    vals_all = ws_all.get_all_values()
+    if not vals_all:
+        ws_all.append_row(HEADERS)
+        vals_all = [HEADERS]
+    else:
+        if vals_all[0] != HEADERS:
+            ws_all.delete_rows(1)
+            ws_all.insert_row(HEADERS, 1)
+            vals_all = ws_all.get_all_values()
+    all_data_count = max(len(vals_all) - 1, 0)
 
 # ---------------------------
 # جلوگیری از تکرار (کلید یکتا: norm_name + norm_task + date + hour(int))
 # + انحصار پری‌سورت به ازای (name,date,hour) صرف‌نظر از لیبل
 # ---------------------------
-existing_keys_hour = set()
+mark_stage("build_keys")
 PRESORT_TYPES = {"Presort", "Presort_Larg"}
-existing_presort_hour = set()  # {(name_norm, date_str, hour_str)}
 
-for r in vals_all[1:]:
-    full_name = norm_name(r[0] if len(r)>0 else "")
-    task_type = norm_task(r[1] if len(r)>1 else "")
-    dt        = norm_date_str(r[3] if len(r)>3 else "")
-    hr_raw    = r[4] if len(r)>4 else ""
-    hr_key    = norm_hour_key(hr_raw)
-    if full_name and dt != "" and hr_key != "":
-        existing_keys_hour.add(f"{full_name}||{task_type}||{dt}||{hr_key}")
-        if task_type in PRESORT_TYPES:
-            existing_presort_hour.add((full_name, dt, hr_key))
+def build_existing_keys(rows):
+    """
+    Serial, or chunked over a fork-based process pool when KEYS_WORKERS > 1.
+    Both paths run common.dedup_keys_for_rows, so the merged sets are identical.
+    """
+    workers = min(KEYS_WORKERS, os.cpu_count() or 1)
+    if workers <= 1 or len(rows) <= KEYS_CHUNK_ROWS:
+        return dedup_keys_for_rows(rows, PRESORT_TYPES)
+
+    chunks = [rows[i:i + KEYS_CHUNK_ROWS] for i in range(0, len(rows), KEYS_CHUNK_ROWS)]
+    keys, presort = set(), set()
+    try:
+        # fork: workers must not re-run this script (spawn would re-import __main__)
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            for k, p in pool.map(dedup_keys_for_rows, chunks, [PRESORT_TYPES] * len(chunks)):
+                keys |= k
+                presort |= p
+        print(f"ℹ️ Built {len(keys)} dedup keys with {workers} workers ({len(chunks)} chunks).")
+        return keys, presort
+    except Exception as e:
+        print(f"⚠️ Parallel key build failed ({e}); falling back to serial.")
+        return dedup_keys_for_rows(rows, PRESORT_TYPES)
+
+def _row_fingerprint(r):
+    return hashlib.sha1(json.dumps(list(r), ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _key_fingerprint(r):
+    # فقط ستون‌های کلید: بازنویسی درجای مجموع/پرفورمنس ردیف آخر باعث rebuild نشود
+    return _row_fingerprint([r[0], r[1], r[3], r[4]])
+
+def open_dedup_stores():
+    """
+    DEDUP_MODE=bloom: persisted KeyStores; only the All_Data rows past the stored
+    watermark are read, normalized and indexed. If the last indexed row no longer
+    matches (rows deleted/edited), the stores are rebuilt page by page.
+    -> (keys, presort, All_Data data rows)
+    """
+    keys = KeyStore(os.path.join(DEDUP_DIR, "keys"), DEDUP_BLOOM_CAPACITY)
+    presort = KeyStore(os.path.join(DEDUP_DIR, "presort"), DEDUP_BLOOM_CAPACITY)
+
+    start = keys.watermark
+    if start and presort.watermark == start:
+        got = ws_all.get(f"A{start + 1}:M{start + 1}")
+        same = any(got) and _key_fingerprint(_pad_row(got[0])) == keys.fingerprint
+    else:
+        same = presort.watermark == start
+    if not same:
+        print("⚠️ Dedup store does not match All_Data; rebuilding.")
+        keys.reset()
+        presort.reset()
+        start = 0
+
+    n, fp, chunk = start, keys.fingerprint, []
+    for r in iter_all_data(start + 2):
+        chunk.append(r)
+        if len(chunk) >= KEYS_CHUNK_ROWS:
+            k, p = dedup_keys_for_rows(chunk, PRESORT_TYPES)
+            keys.index(k)
+            presort.index(p)
+            n, fp, chunk = n + len(chunk), _key_fingerprint(chunk[-1]), []
+    if chunk:
+        k, p = dedup_keys_for_rows(chunk, PRESORT_TYPES)
+        keys.index(k)
+        presort.index(p)
+        n, fp = n + len(chunk), _key_fingerprint(chunk[-1])
+    keys.save(n, fp)
+    presort.save(n, fp)
+    print(f"ℹ️ Dedup store: {n - start} rows indexed, {keys.meta['count']} keys on disk.")
+    return keys, presort, n
+
+if DEDUP_MODE == "bloom":
+    existing_keys_hour, existing_presort_hour, all_data_count = open_dedup_stores()
+else:
+    existing_keys_hour, existing_presort_hour = build_existing_keys(vals_all[1:])  # presort: {(name_norm, date_str, hour_str)}
+run_stats["rows_read"]["All_Data"] = all_data_count
 
 # ---------------------------
 # KPI Config (+ fallback)
 # ---------------------------
+mark_stage("read_config")
 cfg_data = ws_cfg.get_all_values()
+snapshot_tab("KPI_Config", cfg_data)
+run_stats["rows_read"]["KPI_Config"] = max(len(cfg_data) - 1, 0)
 cfg_headers = cfg_data[0] if cfg_data else []
 kpi_configs = []
 for row in cfg_data[1:]:
@@ -297,10 +783,19 @@ def getKPI_with_fallback(task_type, recordDate):
         return getKPI("Presort", recordDate)
     return None
 
+def kpi_perf(task_type, recordDate, qty, occ):
+    """(performance_without_rotation, performance_with_rotation) unrounded, "" without KPI/quantity/minutes."""
+    cfg = getKPI_with_fallback(task_type, recordDate)
+    if cfg and qty > 0 and occ > 0:
+        return (qty / cfg['base']) * 100.0, (qty / (occ * cfg['rotation'])) * 100.0
+    return "", ""
+
 # ---------------------------
 # Other Work — منطق «آخرین تاریخ» (از آن تاریخ به بعد بلاک)
 # ---------------------------
 other = ws_other.get_all_values()
+snapshot_tab("Other Work", other)
+run_stats["rows_read"]["Other Work"] = max(len(other) - 1, 0)
 blocked_from_date = {}  # { norm_name(full_name): date }
 
 if other and len(other) > 1:
@@ -312,7 +807,7 @@ if other and len(other) > 1:
 
         d_only = parse_date_only(ts_raw)
         if not d_only:
-            dt, _ = parse_date_hour(ts_raw, "")
+            dt, _ = parse_date_hour(ts_raw, "", None, "Other Work")
             d_only = dt.date() if dt else None
         if not d_only:
             continue
@@ -343,37 +838,41 @@ def _perf_to_cell(x):
         return ""
     return f"{f:.1f}%" if PERF_AS_PERCENT else float(f"{f:.1f}")
 
-def build_output_row(full_name, task_type, quantity, record_date, hour, occupied,
-                     order_val, user, perf_without, perf_with, ipo_pack, shift):
-    dt_s  = norm_date_str(record_date)
-    qty_s = norm_num(quantity)
-    hr_s  = norm_num(hour)
-    occ_s = norm_num(occupied)
-    ord_s = norm_num(order_val) if str(task_type).startswith("Pack") else ""
-    perf_wo_cell = _perf_to_cell(perf_without)
-    perf_wi_cell = _perf_to_cell(perf_with)
-    neg_min = (60 - occupied) if (occupied and 0 < occupied < 60) else ""
-    row = [
-        norm_name(full_name),
-        norm_task(norm_str(task_type)),
-        qty_s, dt_s, hr_s, occ_s, ord_s,
-        perf_wo_cell, perf_wi_cell, norm_num(neg_min),
-        norm_num(ipo_pack), norm_str(user), norm_str(shift)
-    ]
-    key_hour = f"{norm_name(row[0])}||{norm_task(row[1])}||{row[3]}||{norm_hour_key(row[4])}"
-    return row, key_hour
+class OutRow:
+    """
+    One computed All_Data row: normalized name/task/date, the raw numbers and the
+    dedup key (built once here). cells() formats it for the sheet at write time.
+    """
+    __slots__ = ("name", "task", "quantity", "date", "hour", "occupied", "order", "perf_without",
+                 "perf_with", "ipo_pack", "user", "shift", "hour_key", "key")
+
+    def __init__(self, full_name, task_type, quantity, record_date, hour, occupied,
+                 order_val, user, perf_without, perf_with, ipo_pack, shift):
+        self.name = norm_name(full_name)
+        self.task = norm_task(norm_str(task_type))
+        self.date = norm_date_str(record_date)
+        self.quantity, self.hour, self.occupied, self.order = quantity, hour, occupied, order_val
+        self.perf_without, self.perf_with, self.ipo_pack = perf_without, perf_with, ipo_pack
+        self.user, self.shift = user, shift
+        self.hour_key = norm_hour_key(norm_num(hour))
+        self.key = f"{self.name}||{self.task}||{self.date}||{self.hour_key}"
+
+    def cells(self):
+        occ = self.occupied
+        neg_min = (60 - occ) if (occ and 0 < occ < 60) else ""
+        return [
+            self.name, self.task,
+            norm_num(self.quantity), self.date, norm_num(self.hour), norm_num(occ),
+            norm_num(self.order) if self.task.startswith("Pack") else "",
+            _perf_to_cell(self.perf_without), _perf_to_cell(self.perf_with), norm_num(neg_min),
+            norm_num(self.ipo_pack), norm_str(self.user), norm_str(self.shift),
+        ]
 
 # گارد انحصار پری‌سورت در این اجرا
 seen_new_keys = set()
 seen_new_presort_hour = set()
 
-def _emit_row(full_name, task_type, qty, occ, user, raw_dt, hour_int):
-    # انحصار Presort: اگر برای این (name,date,hour) قبلا پری‌سورت ثبت شده، رد شو
-    if task_type in PRESORT_TYPES:
-        base_triplet = (norm_name(full_name), norm_date_str(raw_dt), norm_hour_key(hour_int))
-        if base_triplet in existing_presort_hour or base_triplet in seen_new_presort_hour:
-            return
-
+def _emit_row(full_name, task_type, qty, occ, user, raw_dt, hour_int, update_existing=False):
     cfg = getKPI_with_fallback(task_type, raw_dt)
     perf_without = perf_with = ""
     if cfg and qty > 0 and occ > 0:
@@ -381,13 +880,31 @@ def _emit_row(full_name, task_type, qty, occ, user, raw_dt, hour_int):
         perf_with    = (qty / (occ * cfg['rotation'])) * 100.0
 
     shift = shift_from_username(user)
-    row, key = build_output_row(full_name, task_type, qty, raw_dt, hour_int, occ,
-                                0, user, perf_without, perf_with, "", shift)
+    row = OutRow(full_name, task_type, qty, raw_dt, hour_int, occ,
+                 0, user, perf_without, perf_with, "", shift)
+    key = row.key
+    if update_existing:
+        # این ساعت قبلاً (با همین برچسب یا برچسب _Larg مقابل) در All_Data ثبت شده؛
+        # اگر مجموع یا override آن عوض شده همان ردیف به‌روز می‌شود
+        base = base_task(row.task)
+        keys = (key, f"{row.name}||{base if base != row.task else base + '_Larg'}||{row.date}||{row.hour_key}")
+        if any(k in existing_keys_hour for k in keys) and not any(k in seen_new_keys for k in keys):
+            bucket_updates[f"{row.name}||{base}||{row.date}||{row.hour_key}"] = row
+            return
+
+    # انحصار Presort: اگر برای این (name,date,hour) قبلا پری‌سورت ثبت شده، رد شو
+    if task_type in PRESORT_TYPES:
+        base_triplet = (row.name, row.date, row.hour_key)
+        if base_triplet in existing_presort_hour or base_triplet in seen_new_presort_hour:
+            _drop(task_type, "presort_exclusive")
+            return
+
     if key in existing_keys_hour or key in seen_new_keys:
+        _drop(task_type, "duplicate")
         return
 
     if task_type in PRESORT_TYPES:
-        base_triplet = (row[0], row[3], norm_hour_key(row[4]))
+        base_triplet = (row.name, row.date, row.hour_key)
         existing_presort_hour.add(base_triplet)
         seen_new_presort_hour.add(base_triplet)
 
@@ -396,60 +913,392 @@ def _emit_row(full_name, task_type, qty, occ, user, raw_dt, hour_int):
     new_rows.append(row)
 
 # ---------------------------
-# تب‌های ساده
+# خواندن ستون‌های لازم از تب‌های ورودی (header یک‌بار، سپس یک batchGet برای ستون‌ها)
 # ---------------------------
-new_rows = []
+SOURCE_COLUMNS = {
+    "full_name", "date", "Date", "hour", "Hour", "Start", "End", "Count", "count",
+    "username", "count_order", "warehouse_name", "warehouses_name",
+}
 
-simple_tabs = ["Receive", "Locate", "Sort", "Pack", "Stock taking"]
-for tab in simple_tabs:
+def read_tab_values(ws, wanted=SOURCE_COLUMNS, first_row=2):
+    """
+    Same shape as ws.get_all_values() (header row + padded rows), restricted to
+    the `wanted` headers and to sheet rows >= first_row. Adjacent columns are
+    fetched as one range.
+    """
+    return list(iter_tab_values(ws, wanted, first_row))
+
+def iter_tab_values(ws, wanted=SOURCE_COLUMNS, first_row=2):
+    """
+    read_tab_values() as a stream: the header, then the rows. With READ_PAGE_ROWS
+    the rows are fetched that many sheet rows at a time and the next page is
+    requested while the caller works on the current one. Trailing empty rows are
+    dropped, so rows line up with sheet rows exactly as in a single read.
+    """
+    if not READ_PAGE_ROWS:
+        data = _fetch_tab_values(ws, wanted, first_row)
+        snapshot_tab(ws.title, data, first_row)
+        yield from data
+        return
+
+    header, fetch = _page_fetcher(ws, wanted)
+    if header is None:
+        snapshot_tab(ws.title, [], first_row)
+        return
+    yield header
+    if fetch is None:
+        snapshot_tab(ws.title, [header], first_row)
+        return
+    kept = [header] if snapshots is not None else None  # فقط برای snapshot کل گرید نگه داشته می‌شود
+
+    last_row = max(ws.row_count, first_row)
+    pages = [(a, min(a + READ_PAGE_ROWS - 1, last_row)) for a in range(first_row, last_row + 1, READ_PAGE_ROWS)]
+    blank, width = 0, len(header)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        nxt = pool.submit(fetch, *pages[0])
+        for i, (a, b) in enumerate(pages):
+            page = nxt.result()
+            if i + 1 < len(pages):
+                nxt = pool.submit(fetch, *pages[i + 1])
+            for r in page:
+                if any(c != "" for c in r):
+                    # ردیف‌های خالی وسط تب نگه داشته می‌شوند، خالی‌های انتهایی نه
+                    for _ in range(blank):
+                        yield [""] * width
+                        if kept is not None:
+                            kept.append([""] * width)
+                    blank = 0
+                    yield r
+                    if kept is not None:
+                        kept.append(r)
+                else:
+                    blank += 1
+            blank += (b - a + 1) - len(page)  # API ردیف‌های خالی انتهای صفحه را برنمی‌گرداند
+    if kept is not None:
+        snapshot_tab(ws.title, kept, first_row)
+
+def _render_options():
+    if TYPED_READS:
+        return {"value_render_option": "UNFORMATTED_VALUE", "date_time_render_option": "SERIAL_NUMBER"}
+    return {}
+
+def _column_spans(head, wanted):
+    """(positions of the wanted headers, [[first, last]] runs of adjacent columns)"""
+    pos = {}
+    for i, c in enumerate(head):
+        if c.strip() in wanted:
+            pos[c.strip()] = i
+    cols = sorted(set(pos.values()))
+    spans = []
+    for c in cols:
+        if spans and c == spans[-1][1] + 1:
+            spans[-1][1] = c
+        else:
+            spans.append([c, c])
+    return cols, spans
+
+def _span_rows(ws, spans, first_row, last_row, render):
+    ranges = [f"{rowcol_to_a1(first_row, a + 1)}:{rowcol_to_a1(last_row, b + 1)}" for a, b in spans]
+    got = ws.batch_get(ranges, major_dimension="COLUMNS", **render)
+    columns = []
+    for (a, b), vr in zip(spans, got):
+        vr = list(vr)
+        for j in range(b - a + 1):
+            columns.append(vr[j] if j < len(vr) else [])
+    return [list(t) for t in zip_longest(*columns, fillvalue="")]
+
+def _page_fetcher(ws, wanted):
+    """(header, fetch(first_row, last_row) -> rows); (None, None) for an empty tab, fetch None without wanted columns."""
+    render = _render_options()
+    if PROJECTED_READS:
+        try:
+            head = ws.row_values(1)
+            if not head:
+                return None, None
+            cols, spans = _column_spans(head, wanted)
+            if not cols:
+                return head, None
+            return [head[c].strip() for c in cols], lambda a, b: _span_rows(ws, spans, a, b, render)
+        except Exception as e:
+            print(f"⚠️ Projected read failed for '{ws.title}' ({e}); reading all columns.")
+    head = ws.row_values(1, **render)
+    if not head:
+        return None, None
+    width = max(len(head), ws.col_count)
+
+    def fetch(a, b):
+        rows = ws.get(f"{rowcol_to_a1(a, 1)}:{rowcol_to_a1(b, width)}", **render)
+        return [list(r) + [""] * (len(head) - len(r)) for r in rows]
+    return head, fetch
+
+def _fetch_tab_values(ws, wanted, first_row):
+    render = _render_options()
+    if not PROJECTED_READS:
+        data = ws.get_all_values(**render)
+        return data[:1] + data[first_row - 1:]
     try:
-        ws = ss.worksheet(tab)
+        head = ws.row_values(1)
+        if not head:
+            return []
+        cols, spans = _column_spans(head, wanted)
+        if not cols:
+            return [head]
+        header = [head[c].strip() for c in cols]
+        return [header] + _span_rows(ws, spans, first_row, max(ws.row_count, first_row), render)
+    except Exception as e:
+        print(f"⚠️ Projected read failed for '{ws.title}' ({e}); reading all columns.")
+        data = ws.get_all_values(**render)
+        return data[:1] + data[first_row - 1:]
+
+# ---------------------------
+# مشخصات تب‌ها: نام ستون‌ها، فیلترها و فیلدهای مشتق‌شده (یک‌بار در هر اجرا compile می‌شوند)
+# ---------------------------
+COLUMN_ALIASES = {
+    "full_name":   ("full_name",),
+    "date":        ("date", "Date"),
+    "hour":        ("hour", "Hour"),
+    "start":       ("Start",),
+    "end":         ("End",),
+    "count":       ("Count", "count"),
+    "username":    ("username",),
+    "count_order": ("count_order",),
+    "warehouse":   ("warehouse_name", "warehouses_name"),
+}
+BASE_FIELDS = ("full_name", "date", "hour", "start", "end", "count", "username")
+OPTIONAL_FIELDS = {"username", "count_order"}
+
+def _derive_pack(quantity, order_val_raw):
+    order_val = float(order_val_raw) if order_val_raw else 0
+    ipo_pack = ""
+    if order_val > 0:
+        ipo_pack = round(quantity / order_val, 2)
+    task_type = "Pack_Single" if (order_val > 0 and 1 <= ipo_pack <= 1.2) else "Pack_Multi"
+    return task_type, order_val, ipo_pack
+
+# min_qty=None یعنی فقط quantity > 0 لازم است (Pick/Presort که بعداً ساعتی جمع می‌شوند)
+# filters: (drop reason, field, predicate) ؛ derive: (fn(quantity, *fields) -> (task_type, order, ipo), fields)
+TAB_SPECS = {
+    "Receive": {},  # فیلتر مرکز از قوانین فیلتر (پیش‌فرض: فقط مرکز پردازش مهرآباد و هاب گنجه)
+    "Locate": {},
+    "Sort": {},
+    "Pack": {
+        "extra": ("count_order",),
+        "derive": (_derive_pack, ("count_order",)),
+        "tasks": ("Pack_Single", "Pack_Multi"),  # نوع‌های مشتق؛ min_qty جداگانه می‌پذیرند
+    },
+    "Stock taking": {},
+    "Pick": {"min_qty": None, "qty_reason": "no_qty_or_time"},
+    "Presort": {"min_qty": None, "qty_reason": "no_qty_or_time"},
+}
+
+# ---------------------------
+# قوانین فیلتر: tab | field | rule | value  (تب Filter_Rules یا فایل JSON با همین کلیدها)
+#   allow_prefix / deny_prefix / exclude روی ستون field از COLUMN_ALIASES
+#   min_qty: حداقل quantity برای tab (ردیف‌های تب‌های ساده)، نوع مشتق آن (Pack_Single / Pack_Multi)
+#            یا task (ساعت‌های Pick/Presort)
+# تبی که در قوانین پیش‌فرض allow دارد ولی در قوانین بارگذاری‌شده هیچ allow معتبری ندارد، allow های پیش‌فرض را می‌گیرد.
+# ---------------------------
+DEFAULT_FILTER_RULES = [
+    {"tab": "Receive", "field": "warehouse", "rule": "allow_prefix", "value": "مرکز پردازش مهرآباد"},
+    {"tab": "Receive", "field": "warehouse", "rule": "allow_prefix", "value": "هاب گنجه"},
+]
+RULE_KINDS = {"allow_prefix": "allow", "deny_prefix": "deny", "exclude": "exclude"}
+
+def load_filter_rules():
+    try:
+        if RULES_PATH:
+            with open(RULES_PATH, encoding="utf-8") as f:
+                rules = json.load(f)
+            print(f"ℹ️ Filter rules: {len(rules)} from {RULES_PATH}.")
+            return rules
+        try:
+            ws = ss.worksheet(RULES_TAB)
+        except gspread.WorksheetNotFound:
+            return DEFAULT_FILTER_RULES
         data = ws.get_all_values()
-        if not data or len(data) < 2:
+        snapshot_tab(RULES_TAB, data)
+        run_stats["rows_read"][RULES_TAB] = max(len(data) - 1, 0)
+        header = [norm_str(h).lower() for h in data[0]] if data else []
+        rules = [dict(zip(header, r)) for r in data[1:]]
+        print(f"ℹ️ Filter rules: {len(rules)} from '{RULES_TAB}'.")
+        return rules
+    except Exception as e:
+        print(f"❌ Error reading filter rules ({e}); using the built-in rules.")
+        return DEFAULT_FILTER_RULES
+
+def with_default_allow(rules):
+    """
+    Adds the built-in allow rules of every tab that has none in `rules`, so an
+    empty or partly filled Filter_Rules never lifts the Receive center allowlist.
+    """
+    allowed = {norm_str(r.get("tab", "")) for r in rules
+               if norm_str(r.get("rule", "")).lower() == "allow_prefix"
+               and norm_str(r.get("field", "")) in COLUMN_ALIASES and norm_name(r.get("value", ""))}
+    extra = [r for r in DEFAULT_FILTER_RULES if r["rule"] == "allow_prefix" and r["tab"] not in allowed]
+    if extra:
+        tabs = sorted({r["tab"] for r in extra})
+        print(f"⚠️ Filter rules have no allow_prefix for {', '.join(tabs)}; using the built-in ones.")
+    return list(rules) + extra
+
+def compile_filter_rules(rules):
+    """-> ({tab: [(drop reason, field, PrefixRules)]}, {tab or task: min qty})"""
+    lists = defaultdict(lambda: {"allow": [], "deny": [], "exclude": []})
+    min_qty = {}
+    for r in rules:
+        tab, field, rule, value = (norm_str(r.get(k, "")) for k in ("tab", "field", "rule", "value"))
+        if not rule:
             continue
-        head = data[0]
-        idx = {c.strip(): i for i, c in enumerate(head)}
+        try:
+            if rule.lower() == "min_qty":
+                min_qty[tab] = float(value)
+            elif rule.lower() in RULE_KINDS and field in COLUMN_ALIASES:
+                lists[(tab, field)][RULE_KINDS[rule.lower()]].append(value)
+            else:
+                raise ValueError("unknown rule or field")
+        except Exception as e:
+            print(f"⚠️ Ignoring filter rule {tab} / {field} / {rule} / {value}: {e}")
+    filters = defaultdict(list)
+    for (tab, field), kinds in lists.items():
+        filters[tab].append((f"{field}_rule", field, PrefixRules(**kinds)))
+    return dict(filters), min_qty
+
+filter_rules, min_qty_rules = compile_filter_rules(with_default_allow(load_filter_rules()))
+
+def min_qty_for(task):
+    """Minimum hourly quantity of a task; *_Larg falls back to its base task, then MIN_QTY_OUT."""
+    if task in min_qty_rules:
+        return min_qty_rules[task]
+    return min_qty_rules.get(task[:-5] if task.endswith("_Larg") else task, MIN_QTY_OUT)
+
+def compile_tab_spec(tab, header, spec=None):
+    """
+    Resolves the spec's columns (and those its filter rules test) against the tab
+    header once. Raises ValueError when a required column is missing (instead of
+    silently reading another one).
+    """
+    spec = TAB_SPECS.get(tab, {}) if spec is None else spec
+    rule_filters = filter_rules.get(tab, [])
+    fields = BASE_FIELDS + tuple(spec.get("extra", ()))
+    fields += tuple(dict.fromkeys(f for _, f, _ in rule_filters if f not in fields))
+    idx = {str(c).strip(): i for i, c in enumerate(header)}
+    pos, missing = {}, []
+    for f in fields:
+        pos[f] = next((idx[a] for a in COLUMN_ALIASES[f] if a in idx), None)
+        if pos[f] is None and f not in OPTIONAL_FIELDS:
+            missing.append("/".join(COLUMN_ALIASES[f]))
+    if missing:
+        raise ValueError(f"missing column(s) {', '.join(missing)}")
+
+    present = [f for f in fields if pos[f] is not None]
+    extract = itemgetter(*(pos[f] for f in present))
+    if len(present) < len(fields):
+        getter = extract
+        slots = [present.index(f) if pos[f] is not None else None for f in fields]
+        def extract(r):
+            got = getter(r)
+            return tuple(got[i] if i is not None else "" for i in slots)
+
+    derive = spec.get("derive")
+    min_qty = spec.get("min_qty", min_qty_rules.get(tab, MIN_QTY_OUT))
+    # min_qty نوع‌های مشتق: بررسی اول با کمترین حد، بعد از derive با حد همان نوع
+    task_min = {t: min_qty_rules[t] for t in spec.get("tasks", ()) if t in min_qty_rules}
+    if task_min and min_qty is not None:
+        task_min = {t: task_min.get(t, min_qty) for t in spec["tasks"]}
+        min_qty = min(task_min.values())
+    return {
+        "extract": extract,
+        "pos": pos,
+        "min_qty": min_qty,
+        "task_min_qty": task_min,
+        "qty_reason": spec.get("qty_reason", "below_min_qty_or_time"),
+        "filters": [(reason, fields.index(f), fn)
+                    for reason, f, fn in tuple(spec.get("filters", ())) + tuple(rule_filters)],
+        "derive": (derive[0], [fields.index(f) for f in derive[1]]) if derive else None,
+    }
+
+parsed_tabs = {}  # tab -> data rows parsed with its compiled spec in this run (archive stage)
+
+def read_tab_records(tab, data=None):
+    """
+    Reads one source tab page by page (or parses `data`, header + rows already
+    read from it) and yields
+    (full_name, record_date, hour, quantity, occupied, user, task_type, order_val, ipo_pack)
+    for the rows that pass the tab's spec; the others are counted in rows_dropped.
+    """
+    rows = iter(iter_tab_values(ss.worksheet(tab)) if data is None else data)
+    header = next(rows, None)
+    head = list(islice(rows, 1000))  # نمونهٔ تشخیص فرمت تاریخ
+    if header is None or not head:
+        run_stats["rows_read"][tab] = parsed_tabs[tab] = 0
+        emit_event("rows_parsed", tab=tab, rows=0)
+        return
+    ex = compile_tab_spec(tab, header)
+    date_col = ex["pos"]["date"]
+    date_parser = DateParser(sample=(r[date_col] for r in head if len(r) > date_col))
+    extract, filters, derive = ex["extract"], ex["filters"], ex["derive"]
+    min_qty, qty_reason, task_min = ex["min_qty"], ex["qty_reason"], ex["task_min_qty"]
+
+    n = 0
+    for r in chain(head, rows):
+        n += 1
+        try:
+            vals = extract(r)
+            full_name, date_raw, hour_raw, start, end, qty, user = vals[:7]
+            if not full_name:
+                _drop(tab, "no_name")
+                continue
 
-        for r in data[1:]:
-            try:
-                full_name = r[idx.get("full_name", -1)]
-                if not full_name:
-                    continue
+            record_date, hour = parse_date_hour(date_raw, hour_raw, date_parser, tab)
+            if not record_date or hour is None:
+                _drop(tab, "bad_date_hour")
+                continue
+            if is_blocked(full_name, record_date, hour):
+                _drop(tab, "blocked")
+                continue
 
-                date_raw = r[idx.get("date", idx.get("Date", -1))]
-                hour_raw = r[idx.get("hour", idx.get("Hour", -1))]
-                record_date, hour = parse_date_hour(date_raw, hour_raw)
-                if not record_date or hour is None:
-                    continue
-                if is_blocked(full_name, record_date, hour):
-                    continue
+            quantity = float(qty) if qty else 0.0
+            fromMin  = float(start) if start else 0.0
+            toMin    = float(end)   if end   else 0.0
+            occupied = (toMin - fromMin + 1) if (toMin - fromMin) > 0 else 0.0
+            if (quantity <= 0 if min_qty is None else quantity < min_qty) or occupied <= 0:
+                _drop(tab, qty_reason)
+                continue
 
-                start = r[idx.get("Start", -1)]
-                end   = r[idx.get("End",   -1)]
-                qty   = r[idx.get("Count", idx.get("count", -1))]
-                user  = r[idx.get("username", -1)]
-                order_val_raw = r[idx.get("count_order", -1)] if "count_order" in idx else ""
+            reason = next((reason for reason, i, fn in filters if not fn(vals[i])), None)
+            if reason:
+                _drop(tab, reason)
+                continue
 
-                quantity = float(qty) if qty else 0
-                fromMin  = float(start) if start else 0
-                toMin    = float(end)   if end   else 0
-                occupied = (toMin - fromMin + 1) if (toMin - fromMin) > 0 else 0
-                if quantity < MIN_QTY_OUT or occupied <= 0:
+            if derive:
+                task_type, order_val, ipo_pack = derive[0](quantity, *(vals[i] for i in derive[1]))
+                if task_min and quantity < task_min.get(task_type, min_qty):
+                    _drop(tab, qty_reason)
                     continue
+            else:
+                task_type, order_val, ipo_pack = tab, 0, ""
+        except Exception as e:
+            _drop(tab, "error")
+            report_error(tab, e, r)
+            continue
+        yield full_name, record_date, hour, quantity, occupied, user, task_type, order_val, ipo_pack
 
-                ipo_pack, task_type = "", tab
-                if tab == "Receive":
-                    center = r[idx.get("warehouse_name", idx.get("warehouses_name", -1))]
-                    if not is_allowed_receive_center(center):
-                        continue  # <-- only مهرآباد center or هاب گنجه
+    # فقط وقتی کل تب (همهٔ صفحه‌ها) خوانده شد
+    run_stats["rows_read"][tab] = parsed_tabs[tab] = n
+    emit_event("rows_parsed", tab=tab, rows=n)
 
-                order_val = 0
-                if tab == "Pack":
-                    order_val = float(order_val_raw) if order_val_raw else 0
-                    if order_val > 0:
-                        ipo_pack = round(quantity / order_val, 2)
-                    task_type = "Pack_Single" if (order_val > 0 and 1 <= ipo_pack <= 1.2) else "Pack_Multi"
+# ---------------------------
+# تب‌های ساده
+# ---------------------------
+mark_stage("simple_tabs")
+new_rows = []
 
+simple_tabs = ["Receive", "Locate", "Sort", "Pack", "Stock taking"]
+for tab in simple_tabs:
+    emitted_before = len(new_rows)
+    emit_event("tab_started", tab=tab)
+    try:
+        for full_name, record_date, hour, quantity, occupied, user, task_type, order_val, ipo_pack in read_tab_records(tab):
+            try:
                 # KPI
                 perf_without = perf_with = ""
                 cfg = getKPI(task_type, record_date)
@@ -459,105 +1308,87 @@ for tab in simple_tabs:
 
                 shift = shift_from_username(user)
                 task_type = norm_task(task_type)
-                row, key = build_output_row(
+                row = OutRow(
                     full_name, task_type, quantity, record_date, hour, occupied,
                     order_val, user, perf_without, perf_with, ipo_pack, shift
                 )
+                key = row.key
                 if key in existing_keys_hour or key in seen_new_keys:
+                    _drop(tab, "duplicate")
                     continue
                 existing_keys_hour.add(key)
                 seen_new_keys.add(key)
                 new_rows.append(row)
             except Exception as e:
-                print(f"❌ Error in {tab}: {e}")
+                _drop(tab, "error")
+                report_error(tab, e, (full_name, record_date, hour, quantity, occupied, user, task_type))
                 continue
     except Exception as e:
         print(f"❌ Worksheet '{tab}' not found or error: {e}")
+    finally:
+        emit_event("tab_finished", tab=tab, rows_emitted=len(new_rows) - emitted_before)
 
 # ---------------------------
 # Pick & Presort + Overrides (ONLY)
 # ---------------------------
-def _read_tab_rows_for(tab_name):
-    rows = []
-    try:
-        ws = ss.worksheet(tab_name)
-        data = ws.get_all_values()
-        if not data or len(data) < 2:
-            return rows
-        head = data[0]
-        idx = {c.strip(): i for i, c in enumerate(head)}
+class HourRow:
+    """A parsed Pick/Presort row; key = (name_key, date, hour) of its hour bucket."""
+    __slots__ = ("key", "name_raw", "raw_date", "quantity", "occupied", "user")
 
-        for r in data[1:]:
-            try:
-                full_name_raw = r[idx.get("full_name", -1)]
-                if not full_name_raw:
-                    continue
+    def __init__(self, full_name_raw, record_date, hour, quantity, occupied, user):
+        self.key = (norm_name(full_name_raw), norm_date_str(record_date), int(hour))
+        self.name_raw, self.raw_date = full_name_raw, record_date
+        self.quantity, self.occupied, self.user = quantity, occupied, user
 
-                date_raw = r[idx.get("date", idx.get("Date", -1))]
-                hour_raw = r[idx.get("hour", idx.get("Hour", -1))]
-                record_date, hour = parse_date_hour(date_raw, hour_raw)
-                if not record_date or hour is None:
-                    continue
-                if is_blocked(full_name_raw, record_date, hour):
-                    continue
+class HourBucket:
+    """Totals of one (name_key, date, hour)."""
+    __slots__ = ("qty", "occ", "user", "dt", "name_raw")
 
-                start = r[idx.get("Start", -1)]
-                end   = r[idx.get("End",   -1)]
-                qty   = r[idx.get("Count", idx.get("count", -1))]
-                user  = r[idx.get("username", -1)]
+    def __init__(self, qty=0.0, occ=0.0, user=None, dt=None, name_raw=None):
+        self.qty, self.occ, self.user, self.dt, self.name_raw = qty, occ, user, dt, name_raw
 
-                quantity = float(qty) if qty else 0.0
-                fromMin  = float(start) if start else 0.0
-                toMin    = float(end)   if end   else 0.0
-                occupied = (toMin - fromMin + 1) if (toMin - fromMin) > 0 else 0.0
-                if quantity <= 0 or occupied <= 0:
-                    continue
-
-                rows.append({
-                    "name_key": norm_name(full_name_raw),
-                    "full_name_raw": full_name_raw,
-                    "raw_date": record_date,
-                    "date": norm_date_str(record_date),
-                    "hour": int(hour),
-                    "quantity": quantity,
-                    "occupied": occupied,
-                    "user": user
-                })
-            except Exception as e:
-                print(f"❌ Error in {tab_name}: {e}")
-                continue
+def _read_tab_rows_for(tab_name, data=None):
+    rows = []
+    emit_event("tab_started", tab=tab_name)
+    try:
+        for full_name_raw, record_date, hour, quantity, occupied, user, *_ in read_tab_records(tab_name, data):
+            rows.append(HourRow(full_name_raw, record_date, hour, quantity, occupied, user))
     except Exception as e:
         print(f"❌ Worksheet '{tab_name}' not found or error: {e}")
+        rows = []  # خطا وسط صفحه‌ها: ساعت‌ها با مجموع ناقص ساخته نشوند
+    emit_event("tab_finished", tab=tab_name, rows_kept=len(rows))
     return rows
 
-def _aggregate_hourly(rows):
-    agg = defaultdict(lambda: {"qty": 0.0, "occ": 0.0, "user": None, "dt": None, "name_raw": None})
+def _aggregate_hourly(rows, agg=None):
+    agg = defaultdict(HourBucket) if agg is None else agg
     for it in rows:
-        k = (it["name_key"], it["date"], it["hour"])
-        a = agg[k]
-        a["qty"] += it["quantity"]
-        a["occ"] += it["occupied"]
-        a["user"] = it["user"]
-        a["dt"]   = it["raw_date"]
-        if not a["name_raw"]:
-            a["name_raw"] = it.get("full_name_raw") or it["name_key"]
+        a = agg[it.key]
+        a.qty += it.quantity
+        a.occ += it.occupied
+        a.user = it.user
+        a.dt   = it.raw_date
+        if not a.name_raw:
+            a.name_raw = it.name_raw or it.key[0]
     return agg
 
 def _read_overrides(ws):
     """
     Larg_Overrides strict headers (with fallback)
+    -> (force, only, ok); ok is False when the tab could not be read as a whole
     """
     force = set()
     only  = {}
     if not ws:
         print("ℹ️ Larg_Overrides sheet not found.")
-        return force, only
+        return force, only, True
 
     try:
         data = ws.get_all_values()
+        snapshot_tab("Larg_Overrides", data)
+        run_stats["rows_read"]["Larg_Overrides"] = max(len(data) - 1, 0)
         if not data or len(data) < 2:
             print("ℹ️ Larg_Overrides is empty.")
-            return force, only
+            return force, only, True
 
         header = [(h or "").strip() for h in data[0]]
 
@@ -589,7 +1420,7 @@ def _read_overrides(ws):
 
         if min(col_date, col_hour, col_name, col_type) < 0:
             print("❌ Larg_Overrides headers not found (need تاریخ/ساعت/نام/نوع). No overrides applied.")
-            return force, only
+            return force, only, False
 
         for r in data[1:]:
             try:
@@ -612,7 +1443,7 @@ def _read_overrides(ws):
                 if t not in ("pick", "presort"):
                     continue
 
-                dt, hr = parse_date_hour(date_raw, hour_raw)
+                dt, hr = parse_date_hour(date_raw, hour_raw, None, "Larg_Overrides")
                 if not dt or hr is None:
                     d_only = parse_date_only(date_raw)
                     if d_only is None:
@@ -629,20 +1460,174 @@ def _read_overrides(ws):
                 force.add(key)
                 only[key] = t
             except Exception as e:
-                print(f"❌ Error reading a row in Larg_Overrides: {e}")
+                report_error("Larg_Overrides", e, r)
                 continue
 
     except Exception as e:
         print(f"❌ Error reading Larg_Overrides: {e}")
+        return force, only, False
 
-    return force, only
+    return force, only, True
 
-pick_agg    = _aggregate_hourly(_read_tab_rows_for("Pick"))
-presort_agg = _aggregate_hourly(_read_tab_rows_for("Presort"))
-force_larg, force_only = _read_overrides(ws_override)
+# ---------------------------
+# وضعیت ساعتی Pick/Presort بین اجراها: watermark هر تب + مجموع‌های ساعت‌های اخیر
+# ---------------------------
+def load_bucket_state():
+    if not HOUR_BUCKETS_PATH:
+        return None
+    try:
+        with open(HOUR_BUCKETS_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    if state.get("spreadsheet") != SPREADSHEET_ID:
+        state = {}
+    state.setdefault("tabs", {})
+    state.setdefault("buckets", {})
+    state["next"] = {}
+    return state
+
+def _read_tab_tail(tab, mark):
+    """
+    (data, mark, incremental): header + the rows after the tab's watermark, or the
+    whole tab when the header or the last folded row no longer match (edited/removed
+    rows). The rows are streamed; `mark` gets the new watermark once they are consumed.
+    """
+    ws = ss.worksheet(tab)
+    wm = int(mark.get("watermark") or 0)
+    if wm:
+        # از ردیفِ آخرین ردیف جمع‌شده می‌خوانیم تا fingerprint آن بررسی شود
+        it = iter_tab_values(ws, first_row=wm + 1)
+        header, last = next(it, None), next(it, None)
+        if last is not None and header == mark.get("header") and _row_fingerprint(last) == mark.get("fingerprint"):
+            mark = dict(mark)
+            return _track_watermark(header, it, mark, wm), mark, True
+        it.close()
+        print(f"⚠️ {tab} changed at or above its watermark (row {wm + 1}); re-aggregating the whole tab.")
+    it = iter_tab_values(ws)
+    header = next(it, None)
+    mark = {"header": header or [], "watermark": 0, "fingerprint": None}
+    if header is None:
+        return [], mark, False
+    return _track_watermark(header, it, mark, 0), mark, False
+
+def _track_watermark(header, rows, mark, wm):
+    """Passes header + rows through, then sets the watermark and last-row fingerprint in `mark`."""
+    yield header
+    n, last = 0, None
+    for r in rows:
+        n, last = n + 1, r
+        yield r
+    if n:
+        mark.update(header=header, watermark=wm + n, fingerprint=_row_fingerprint(last))
+
+def read_hour_buckets(tab, state, horizon):
+    """
+    (agg, keys): hourly totals of the tab and the hours that got rows in this run.
+    With a state, only rows after the tab's watermark are read; they are folded
+    into the saved totals of hours >= horizon.
+    """
+    if state is None:
+        agg = _aggregate_hourly(_read_tab_rows_for(tab))
+        return agg, set(agg)
+    try:
+        data, mark, incremental = _read_tab_tail(tab, state["tabs"].get(tab) or {})
+    except Exception as e:
+        print(f"❌ Worksheet '{tab}' not found or error: {e}")
+        return defaultdict(HourBucket), set()
+
+    agg = defaultdict(HourBucket)
+    if incremental:
+        for name_key, date_s, hour, qty, occ, user, name_raw in state["buckets"].get(tab, []):
+            if date_s >= horizon:
+                agg[(name_key, date_s, hour)] = HourBucket(qty, occ, user, datetime.strptime(date_s, "%Y-%m-%d"), name_raw)
+    rows = _read_tab_rows_for(tab, data)
+    _aggregate_hourly(rows, agg)
+    state["next"][tab] = (mark, agg)
+    print(f"ℹ️ {tab}: {len(rows)} rows folded into hour buckets "
+          f"({'incremental' if incremental else 'full read'}, watermark {mark['watermark']}).")
+    return agg, {it.key for it in rows}
+
+def override_changes(state, only, horizon):
+    """Hours >= horizon whose Larg_Overrides entry was added, removed or changed since the saved state."""
+    if state is None or "overrides" not in state:
+        return set()
+    prev = {(n, d, int(h)): m for n, d, h, m in state["overrides"] if d >= horizon}
+    cur = {k: m for k, m in only.items() if k[1] >= horizon}
+    return {k for k in prev.keys() | cur.keys() if prev.get(k) != cur.get(k)}
+
+def save_bucket_state(state, horizon, overrides=None):
+    """
+    Called after the append so a failed run re-reads the same rows next time.
+    `overrides` (Larg_Overrides modes) is saved only when both tabs were read, so
+    a changed override is applied together with complete hour totals.
+    """
+    if state is None or not state["next"]:
+        return
+    out = {"spreadsheet": SPREADSHEET_ID, "tabs": dict(state["tabs"]), "buckets": dict(state["buckets"])}
+    if "overrides" in state:
+        out["overrides"] = state["overrides"]
+    if overrides is not None and {"Pick", "Presort"} <= set(state["next"]):
+        out["overrides"] = [[k[0], k[1], k[2], m] for k, m in sorted(overrides.items()) if k[1] >= horizon]
+    for tab, (mark, agg) in state["next"].items():
+        out["tabs"][tab] = mark
+        out["buckets"][tab] = [
+            [k[0], k[1], k[2], a.qty, a.occ, a.user, a.name_raw]
+            for k, a in agg.items() if k[1] >= horizon
+        ]
+    tmp = HOUR_BUCKETS_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(out, f, ensure_ascii=False)
+    os.replace(tmp, HOUR_BUCKETS_PATH)
+
+HOUR_TASKS = {"Pick", "Pick_Larg", "Presort", "Presort_Larg"}
+
+def apply_bucket_updates():
+    """
+    Rewrites the All_Data rows of already-emitted hours whose totals or Larg
+    label changed (also in vals_all, so kpi_backfill sees them). Rows are matched
+    on the task without _Larg; only rows of the updated hours' dates are fetched.
+    Returns the new rows.
+    """
+    if not bucket_updates:
+        return []
+    dates = {k.rsplit("||", 2)[1] for k in bucket_updates}
+    updates, new_rows_v = [], []
+    for n, cur in all_data_rows(lambda task, d: norm_task(task) in HOUR_TASKS and norm_date_str(d) in dates):
+        key = f"{norm_name(cur[0])}||{base_task(norm_task(cur[1]))}||{norm_date_str(cur[3])}||{norm_hour_key(cur[4])}"
+        row = bucket_updates.pop(key, None)
+        if row is None:
+            continue
+        row = row.cells()
+        if [norm_str(c) for c in cur] == [norm_str(c) for c in row]:
+            continue
+        updates.append((n, row))
+        new_rows_v.append(row)
+        if vals_all is not None:
+            vals_all[n - 1] = row
+
+    data = _merge_row_spans(updates, cols=("A", "M"))
+    journal_rows("hour_buckets", new_rows_v)
+    for i in range(0, len(data), KPI_BACKFILL_BATCH):
+        ws_all.batch_update(data[i:i + KPI_BACKFILL_BATCH], value_input_option="RAW")
+    if updates:
+        print(f"🔁 Hour buckets: {len(updates)} All_Data rows updated with new totals in {len(data)} ranges.")
+    emit_event("hour_buckets", rows=len(updates), ranges=len(data))
+    return new_rows_v
+
+mark_stage("pick_presort")
+bucket_state = load_bucket_state()
+bucket_horizon = (datetime.now() - timedelta(days=HOUR_BUCKET_DAYS)).strftime("%Y-%m-%d")
+pick_agg, pick_keys       = read_hour_buckets("Pick", bucket_state, bucket_horizon)
+presort_agg, presort_keys = read_hour_buckets("Presort", bucket_state, bucket_horizon)
+force_larg, force_only, overrides_ok = _read_overrides(ws_override)
+bucket_updates = {}  # key (task بدون _Larg) -> OutRow of an already-emitted hour whose totals or label changed
 
 # منطق نهایی (فقط Overrides تعیین می‌کند *_Larg* باشد یا نه)
-all_keys = set(pick_agg.keys()) | set(presort_agg.keys())
+# فقط ساعت‌هایی که در این اجرا ردیف جدید یا override تازه/تغییرکرده گرفته‌اند؛ مجموع‌ها از وضعیت ذخیره‌شده می‌آیند
+all_keys = pick_keys | presort_keys
+if overrides_ok:
+    all_keys |= override_changes(bucket_state, force_only, bucket_horizon)
 
 for (name_key, date_s, hour_int) in all_keys:
     p = pick_agg.get((name_key, date_s, hour_int))
@@ -650,37 +1635,598 @@ for (name_key, date_s, hour_int) in all_keys:
 
     in_force = (name_key, date_s, int(hour_int)) in force_larg
     mode = force_only.get((name_key, date_s, int(hour_int)))  # 'pick' | 'presort' | None
-    display_name = (p and p.get("name_raw")) or (s and s.get("name_raw")) or name_key
+    display_name = (p and p.name_raw) or (s and s.name_raw) or name_key
+    upd = bucket_state is not None and date_s >= bucket_horizon
 
     if in_force:
         # فقط همان نوع override شده لارج می‌شود؛ نوع دیگر (اگر وجود داشته باشد) نرمال ثبت می‌گردد
         if mode == "pick":
-            if p and p["qty"] >= MIN_QTY_OUT:
-                _emit_row(display_name, "Pick_Larg", p["qty"], p["occ"], p["user"], p["dt"], hour_int)
-            if s and s["qty"] >= MIN_QTY_OUT:
-                _emit_row(display_name, "Presort",   s["qty"], s["occ"], s["user"], s["dt"], hour_int)
+            if p and p.qty >= min_qty_for("Pick_Larg"):
+                _emit_row(display_name, "Pick_Larg", p.qty, p.occ, p.user, p.dt, hour_int, upd)
+            if s and s.qty >= min_qty_for("Presort"):
+                _emit_row(display_name, "Presort",   s.qty, s.occ, s.user, s.dt, hour_int, upd)
         elif mode == "presort":
-            if s and s["qty"] >= MIN_QTY_OUT:
-                _emit_row(display_name, "Presort_Larg", s["qty"], s["occ"], s["user"], s["dt"], hour_int)
-            if p and p["qty"] >= MIN_QTY_OUT:
-                _emit_row(display_name, "Pick",         p["qty"], p["occ"], p["user"], p["dt"], hour_int)
+            if s and s.qty >= min_qty_for("Presort_Larg"):
+                _emit_row(display_name, "Presort_Larg", s.qty, s.occ, s.user, s.dt, hour_int, upd)
+            if p and p.qty >= min_qty_for("Pick"):
+                _emit_row(display_name, "Pick",         p.qty, p.occ, p.user, p.dt, hour_int, upd)
         continue
 
     # بدون override: هیچ *_Larg* نداریم
-    if p and p["qty"] >= MIN_QTY_OUT:
-        _emit_row(display_name, "Pick", p["qty"], p["occ"], p["user"], p["dt"], hour_int)
-    if s and s["qty"] >= MIN_QTY_OUT:
-        _emit_row(display_name, "Presort", s["qty"], s["occ"], s["user"], s["dt"], hour_int)
+    if p and p.qty >= min_qty_for("Pick"):
+        _emit_row(display_name, "Pick", p.qty, p.occ, p.user, p.dt, hour_int, upd)
+    if s and s.qty >= min_qty_for("Presort"):
+        _emit_row(display_name, "Presort", s.qty, s.occ, s.user, s.dt, hour_int, upd)
+
+# ---------------------------
+# خروجی ستونی (Parquet / Arrow IPC) — پارتیشن بر اساس تاریخ؛ پارتیشن هر تاریخ تغییرکرده
+# از روی All_Data دوباره و در یک فایل نوشته می‌شود
+# ---------------------------
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as pa_ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+def _cell_float(x):
+    s = norm_str(x).rstrip("%")
+    if not s:
+        return None
+    try:
+        return float(s)
+    except:
+        return None
+
+def _cell_int(x):
+    f = _cell_float(x)
+    return int(round(f)) if f is not None else None
+
+def row_values(r):
+    """
+    Typed values of an All_Data row, in HEADERS order. Performance is the unrounded
+    value recomputed from quantity, minutes and KPI_Config when it rounds to the
+    cell; otherwise (KPI_Config changed without a backfill) the cell's own value.
+    """
+    r = _pad_row(r)
+    qty, occ = _cell_float(r[2]), _cell_float(r[5])
+    perf = [_cell_float(r[7]), _cell_float(r[8])]
+    if None not in perf:
+        try:
+            raw = kpi_perf(norm_task(r[1]), datetime.strptime(norm_str(r[3]), "%Y-%m-%d"), qty or 0.0, occ or 0.0)
+        except ValueError:
+            raw = ("", "")
+        if "" not in raw and [_cell_float(_perf_to_cell(x)) for x in raw] == perf:
+            perf = list(raw)
+    return [
+        norm_str(r[0]), norm_str(r[1]), qty, norm_str(r[3]), _cell_int(r[4]), _cell_int(r[5]),
+        _cell_float(r[6]), perf[0], perf[1], _cell_int(r[9]), _cell_float(r[10]),
+        norm_str(r[11]), norm_str(r[12]),
+    ]
+
+def export_rows_columnar(rows):
+    """
+    Re-exports every date that `rows` touch from All_Data, one file per date:
+      EXPORT_DIR/date=YYYY-MM-DD/data.parquet (or .arrow)
+    The file replaces the date's previous export (and older per-run part files),
+    so re-running an export never duplicates rows. -> False on error
+    """
+    if not EXPORT_DIR or not rows:
+        return True
+    if pa is None:
+        print("⚠️ EXPORT_DIR is set but pyarrow is not installed; columnar export skipped.")
+        return True
+
+    use_ipc = EXPORT_FORMAT in ("arrow", "ipc", "feather")
+    ext = "arrow" if use_ipc else "parquet"
+
+    dates = {norm_date_str(r[3]) for r in rows} - {""}
+    by_date = {d: [] for d in dates}
+    for _, r in all_data_rows(lambda task, d: norm_date_str(d) in dates):
+        by_date[norm_date_str(r[3])].append(row_values(r))
+
+    def dict_col(part, i):
+        return pa.array([v[i] for v in part], pa.string()).dictionary_encode()
+
+    def col(part, i, typ):
+        return pa.array([v[i] for v in part], typ)
+
+    written = 0
+    try:
+        for date_s, part in sorted(by_date.items()):
+            out_dir = os.path.join(EXPORT_DIR, f"date={date_s}")
+            os.makedirs(out_dir, exist_ok=True)
+            name = f"data.{ext}"
+            if part:
+                d = parse_date_only(date_s)
+                table = pa.table({
+                    "full_name": dict_col(part, 0),
+                    "task_type": dict_col(part, 1),
+                    "quantity": col(part, 2, pa.float64()),
+                    "date": pa.array([d] * len(part), pa.date32()),
+                    "hour": col(part, 4, pa.int8()),
+                    "occupied_hours": col(part, 5, pa.int32()),
+                    "order": col(part, 6, pa.float64()),
+                    "performance_without_rotation": col(part, 7, pa.float64()),
+                    "performance_with_rotation": col(part, 8, pa.float64()),
+                    "Negative_Minutes": col(part, 9, pa.int32()),
+                    "Ipo_Pack": col(part, 10, pa.float64()),
+                    "UserName": dict_col(part, 11),
+                    "Shift": dict_col(part, 12),
+                })
+                path = os.path.join(out_dir, name)
+                tmp = path + ".tmp"
+                if use_ipc:
+                    with pa.OSFile(tmp, "wb") as sink:
+                        with pa_ipc.new_file(sink, table.schema) as w:
+                            w.write_table(table)
+                else:
+                    pq.write_table(table, tmp, compression="zstd")
+                os.replace(tmp, path)
+                written += len(part)
+            # فایل‌های قبلی این تاریخ (part-<run> های قدیمی یا فرمت دیگر) جایگزین شده‌اند
+            for f in os.listdir(out_dir):
+                if f != name or not part:
+                    os.remove(os.path.join(out_dir, f))
+        print(f"📦 Exported {written} rows to {EXPORT_DIR} ({ext}, {len(by_date)} date partitions rewritten).")
+        return True
+    except Exception as e:
+        print(f"❌ Columnar export error: {e}")
+        return False
+
+# ---------------------------
+# Rollup تجمیعی — ردیف‌های خلاصهٔ هر تاریخی که این اجرا تغییر داده از روی All_Data دوباره محاسبه می‌شود
+# ---------------------------
+ROLLUP_HEADERS = [
+    'full_name','date','task_type','Shift',
+    'quantity','occupied_minutes','Negative_Minutes',
+    'performance_without_rotation','performance_with_rotation','rows',
+    'perf_minutes','perf_without_x_minutes','perf_with_x_minutes'
+]
+# ستون‌های جمع‌پذیر (E..M به جز دو ستون میانگین وزنی)
+_ROLLUP_SUM_COLS = (4, 5, 6, 9, 10, 11, 12)
+
+def _sheet_num(f):
+    return int(f) if float(f).is_integer() else round(f, 6)
+
+def _rollup_values(sums):
+    qty, occ, neg, n, perf_min, wo_x, wi_x = sums
+    perf_wo = _perf_to_cell(wo_x / perf_min) if perf_min > 0 else ""
+    perf_wi = _perf_to_cell(wi_x / perf_min) if perf_min > 0 else ""
+    return [
+        _sheet_num(qty), _sheet_num(occ), _sheet_num(neg),
+        perf_wo, perf_wi, int(n),
+        _sheet_num(perf_min), _sheet_num(wo_x), _sheet_num(wi_x)
+    ]
+
+def _rollup_same(have, want):
+    """Existing rollup cells (UNFORMATTED_VALUE) already equal to the recomputed ones"""
+    have = list(have) + [""] * (len(want) - len(have))
+    for a, b in zip(have, want):
+        if norm_str(a) == norm_str(b):
+            continue
+        fa, fb = _cell_float(a), _cell_float(b)
+        if fa is None or fb is None or abs(fa - fb) > 1e-6 * max(1.0, abs(fb)):
+            return False
+    return True
+
+def _rollup_add(v, sums):
+    """v: row_values() of one All_Data row"""
+    d = sums[(v[0], v[3], v[1], v[12])]
+    occ = v[5] or 0
+    d[0] += v[2] or 0.0
+    d[1] += occ
+    d[2] += v[9] or 0
+    d[3] += 1
+    p_wo, p_wi = v[7], v[8]
+    if p_wo is not None and p_wi is not None and occ > 0:
+        d[4] += occ
+        d[5] += p_wo * occ
+        d[6] += p_wi * occ
+
+def update_rollups(rows):
+    """
+    Recomputes the rollup rows of every date that `rows` touch from All_Data, so a
+    replayed or half-applied update converges instead of double counting.
+    Weighted performance = Σ(perf × occupied) / Σ occupied over rows that have a KPI,
+    from the unrounded performance of row_values(). -> False on error
+    """
+    if not ROLLUP_TAB or not rows:
+        return True
+    dates = {norm_date_str(r[3]) for r in rows} - {""}
+    try:
+        try:
+            ws_r = ss.worksheet(ROLLUP_TAB)
+        except gspread.WorksheetNotFound:
+            ws_r = ss.add_worksheet(title=ROLLUP_TAB, rows=1000, cols=len(ROLLUP_HEADERS))
+            print(f"ℹ️ Created rollup tab '{ROLLUP_TAB}'.")
+
+        data = ws_r.get_all_values(value_render_option="UNFORMATTED_VALUE")
+        if not data or not any(data[0]):
+            # تب خالی: get_all_values به جای [] مقدار [[]] برمی‌گرداند
+            ws_r.append_row(ROLLUP_HEADERS)
+            data = [ROLLUP_HEADERS]
+        elif [norm_str(h) for h in data[0]] != ROLLUP_HEADERS:
+            print(f"❌ Rollup tab '{ROLLUP_TAB}' has unexpected headers. Rollups not updated.")
+            return False
+
+        index = {}  # (name, date, task, shift) -> (sheet row number, E..M فعلی)
+        for n, r in enumerate(data[1:], start=2):
+            r = list(r) + [""] * (len(ROLLUP_HEADERS) - len(r))
+            index[(norm_str(r[0]), norm_str(r[1]), norm_str(r[2]), norm_str(r[3]))] = (n, r[4:])
+
+        sums = defaultdict(lambda: [0.0] * len(_ROLLUP_SUM_COLS))
+        for _, r in all_data_rows(lambda task, d: norm_date_str(d) in dates):
+            _rollup_add(row_values(r), sums)
+
+        # فقط ردیف‌هایی که مقدارشان واقعاً عوض شده نوشته می‌شوند
+        updates, appends = [], []
+        zero = _rollup_values([0.0] * len(_ROLLUP_SUM_COLS))
+        for key, (n, have) in index.items():
+            if key[1] in dates and key not in sums and not _rollup_same(have, zero):
+                # دیگر ردیفی در All_Data ندارد
+                updates.append((n, zero))
+        for key, s in sums.items():
+            vals = _rollup_values(s)
+            if key not in index:
+                appends.append(list(key) + vals)
+            elif not _rollup_same(index[key][1], vals):
+                updates.append((index[key][0], vals))
+
+        data = _merge_row_spans(sorted(updates), cols=("E", "M"))
+        if data:
+            ws_r.batch_update(data, value_input_option="RAW")
+        if appends:
+            ws_r.append_rows(appends, value_input_option="RAW")
+        print(f"📊 Rollups: {len(updates)} updated in {len(data)} ranges, {len(appends)} added in '{ROLLUP_TAB}'.")
+        return True
+    except Exception as e:
+        print(f"❌ Rollup update error: {e}")
+        return False
+
+# ---------------------------
+# KPI backfill — فقط ردیف‌های (task_type, date >= effective) مربوط به ورودی‌های تغییرکرده
+# ---------------------------
+# اگر KPI این نوع‌ها تغییر کند، *_Larg* هایی که KPI اختصاصی ندارند هم تغییر می‌کنند
+_KPI_FALLBACK_DEPENDENTS = {"Pick": ("Pick_Larg",), "Presort": ("Presort_Larg",)}
+
+def _kpi_snapshot():
+    return sorted({
+        (c["task_type"], c["base"], c["rotation"], c["effective"].strftime("%Y-%m-%d"))
+        for c in kpi_configs
+    })
+
+def _save_kpi_snapshot(snap):
+    tmp = KPI_STATE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snap, f, ensure_ascii=False)
+    os.replace(tmp, KPI_STATE_PATH)
+
+def _merge_row_spans(updates, cols=("H", "I")):
+    """[(sheet_row, [wo, wi]), ...] sorted -> [{"range": "H{a}:I{b}", "values": [...]}, ...]"""
+    spans = []
+    for n, vals in updates:
+        if spans and spans[-1]["end"] == n - 1:
+            spans[-1]["end"] = n
+            spans[-1]["values"].append(vals)
+        else:
+            spans.append({"start": n, "end": n, "values": [vals]})
+    return [{"range": f"{cols[0]}{s['start']}:{cols[1]}{s['end']}", "values": s["values"]} for s in spans]
+
+def kpi_backfill():
+    """
+    Compares KPI_Config with the snapshot of the previous run and rewrites only
+    the two performance cells of affected All_Data rows whose value changes.
+    Returns the updated rows (for export / rollups / records log).
+    """
+    if KPI_BACKFILL in ("off", "0", "") or not KPI_STATE_PATH:
+        return []
+    snap = _kpi_snapshot()
+    try:
+        with open(KPI_STATE_PATH, encoding="utf-8") as f:
+            prev = [tuple(e) for e in json.load(f)]
+    except (OSError, ValueError):
+        _save_kpi_snapshot(snap)
+        print("ℹ️ KPI snapshot saved (no previous snapshot to compare).")
+        return []
+
+    changed = set(snap) ^ set(prev)
+    if not changed:
+        return []
+
+    since = {}  # task_type -> earliest affected date
+    for task, _, _, eff in changed:
+        for t in (task,) + _KPI_FALLBACK_DEPENDENTS.get(task, ()):
+            if t not in since or eff < since[t]:
+                since[t] = eff
+
+    def affected(task, d):
+        d0 = since.get(norm_task(task))
+        return d0 is not None and d >= d0
+
+    updates, new_rows_v = [], []
+    for n, r in all_data_rows(affected):
+        task = norm_task(r[1])
+        try:
+            rec_dt = datetime.strptime(r[3], "%Y-%m-%d")
+        except ValueError:
+            continue
+        perf_without, perf_with = kpi_perf(task, rec_dt, _cell_float(r[2]) or 0.0, _cell_float(r[5]) or 0.0)
+        cells = [_perf_to_cell(perf_without), _perf_to_cell(perf_with)]
+        if cells != [r[7], r[8]]:
+            updates.append((n, cells))
+            new_rows_v.append(r[:7] + cells + r[9:])
+            if vals_all is not None:
+                vals_all[n - 1] = new_rows_v[-1]
+
+    data = _merge_row_spans(updates)
+    journal_rows("kpi_backfill", new_rows_v)
+    for i in range(0, len(data), KPI_BACKFILL_BATCH):
+        ws_all.batch_update(data[i:i + KPI_BACKFILL_BATCH], value_input_option="RAW")
+    _save_kpi_snapshot(snap)
+    print(f"🔁 KPI backfill: {len(changed)} changed KPI entries, {len(updates)} rows re-computed "
+          f"in {len(data)} ranges.")
+    emit_event("kpi_backfill", entries=len(changed), rows=len(updates), ranges=len(data))
+    return new_rows_v
+
+# ---------------------------
+# لاگ ردیف‌های پردازش‌شده برای ایندکس خواندنی web.py
+# (بار اول کل All_Data موجود، بعد از آن فقط ردیف‌های جدید/بازمحاسبه‌شدهٔ هر اجرا)
+# ---------------------------
+def update_records_log(rows):
+    if not RECORDS_PATH:
+        return True
+    try:
+        seed = not os.path.exists(RECORDS_PATH)
+        if not seed:
+            batch = rows
+            if not batch:
+                return True
+        else:
+            # vals_all (یا در حالت bloom خود شیت، صفحه به صفحه) ردیف‌های recovered و همین اجرا را دارد
+            batch = (r for r in (vals_all[1:] if vals_all is not None else iter_all_data()) if r and norm_str(r[0]))
+        n = 0
+        with open(RECORDS_PATH, "a", encoding="utf-8") as f:
+            for r in batch:
+                f.write(json.dumps(_pad_row(r), ensure_ascii=False) + "\n")
+                n += 1
+        if seed:
+            print(f"ℹ️ Seeded records log with {n} rows ({RECORDS_PATH}).")
+        return True
+    except Exception as e:
+        print(f"❌ Records log error: {e}")
+        return False
+
+# ---------------------------
+# بایگانی تب‌های ورودی: ردیف‌های قدیمی‌تر از ARCHIVE_DAYS که این اجرا پردازش کرده
+# (پس در All_Data هستند) با fingerprint به بایگانی ماهانه منتقل و از تب حذف می‌شوند.
+# ژورنال قبل از نوشتن ثبت می‌شود؛ اجرای قطع‌شده در اجرای بعد اول تکمیل می‌شود.
+# ---------------------------
+ARCHIVE_TABS = simple_tabs + ["Pick", "Presort"]
+archive_store = ArchiveStore(ARCHIVE_DIR) if ARCHIVE_TARGET == "local" else None
+_archive_sheets = {}
+
+def _archive_sheet(tab, month, header):
+    title = f"{tab} Archive {month}"
+    if title not in _archive_sheets:
+        try:
+            ws = ss.worksheet(title)
+        except gspread.WorksheetNotFound:
+            ws = ss.add_worksheet(title=title, rows=1000, cols=len(header) + 1)
+            ws.append_row(list(header) + ["_fingerprint"], value_input_option="RAW")
+            print(f"ℹ️ Created archive tab '{title}'.")
+        _archive_sheets[title] = ws
+    return _archive_sheets[title]
+
+def _archive_write(tab, header, months, skip_existing=False):
+    """months: {YYYY-MM: [(fingerprint, row)]}; skip_existing drops rows a crashed run already wrote."""
+    width = len(header)
+    for month, items in sorted(months.items()):
+        if archive_store is not None:
+            if skip_existing:
+                have = archive_store.fingerprints(tab, month)
+                items = [it for it in items if it[0] not in have]
+            if items:
+                archive_store.append(tab, month, header, items)
+            continue
+        ws = _archive_sheet(tab, month, header)
+        if skip_existing:
+            head = ws.row_values(1)
+            have = set(ws.col_values(head.index("_fingerprint") + 1)) if "_fingerprint" in head else set()
+            items = [it for it in items if it[0] not in have]
+        rows = [list(r) + [""] * (width - len(r)) + [fp] for fp, r in items]
+        for i in range(0, len(rows), APPEND_CHUNK_ROWS):
+            ws.append_rows(rows[i:i + APPEND_CHUNK_ROWS], value_input_option="RAW")
+
+def _archive_journal_save(job):
+    tmp = ARCHIVE_JOURNAL_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, ARCHIVE_JOURNAL_PATH)
+
+def _shift_bucket_mark(tab, ws, deleted):
+    """Deleted rows at or above the saved Pick/Presort watermark move it up, so the next run still reads only the tail."""
+    if not HOUR_BUCKETS_PATH or tab not in ("Pick", "Presort"):
+        return
+    try:
+        with open(HOUR_BUCKETS_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return
+    mark = state.get("tabs", {}).get(tab)
+    if not mark:
+        return
+    wm = int(mark.get("watermark") or 0)
+    gone = sum(1 for n in deleted if n - 1 <= wm)
+    if not gone:
+        return
+    wm -= gone
+    fp = None
+    if wm:
+        data = _fetch_tab_values(ws, SOURCE_COLUMNS, wm + 1)
+        fp = _row_fingerprint(data[1]) if len(data) > 1 else None
+    mark.update(watermark=wm, fingerprint=fp)
+    tmp = HOUR_BUCKETS_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, HOUR_BUCKETS_PATH)
+
+def _archive_finish(job):
+    """Deletes the journaled rows from the live tab, found again by fingerprint. -> rows deleted"""
+    tab = job["tab"]
+    gone = {fp for items in job["months"].values() for fp, _ in items}
+    ws = ss.worksheet(tab)
+    grid = ws.get_all_values()
+    doomed = [n for n, fp in enumerate(archive_fps(tab, grid[1:]), start=2) if fp in gone]
+    if len(doomed) != len(gone):
+        print(f"⚠️ {tab}: only {len(doomed)} of {len(gone)} archived rows are still in the tab; deleting those.")
+    delete_sheet_rows(ss, ws, doomed)
+    _shift_bucket_mark(tab, ws, doomed)
+    if snapshots is not None and tab in _snapshot_tabs:
+        try:
+            sha, _ = snapshots.put(_fetch_tab_values(ws, SOURCE_COLUMNS, 2))
+            _snapshot_tabs[tab]["after_archive"] = sha
+        except Exception as e:
+            print(f"⚠️ Snapshot of '{tab}' after archiving failed: {e}")
+    os.remove(ARCHIVE_JOURNAL_PATH)
+    return len(doomed)
+
+def _archive_row_limit(tab):
+    """Sheet rows 2..n+1 of the tab were parsed by this run and are reflected in All_Data -> n"""
+    if tab not in parsed_tabs:
+        return 0
+    if tab in ("Pick", "Presort") and bucket_state is not None:
+        # فقط ردیف‌های تا watermark ذخیره‌شده جمع و نوشته شده‌اند
+        try:
+            with open(HOUR_BUCKETS_PATH, encoding="utf-8") as f:
+                return int((json.load(f).get("tabs", {}).get(tab) or {}).get("watermark") or 0)
+        except (OSError, ValueError):
+            return 0
+    return parsed_tabs[tab]
+
+def archive_source_tabs():
+    if ARCHIVE_DAYS <= 0:
+        return
+    # ساعت‌های قابل به‌روزرسانی (HOUR_BUCKET_DAYS) هیچ‌وقت بایگانی نمی‌شوند
+    cutoff = (datetime.now() - timedelta(days=max(ARCHIVE_DAYS, HOUR_BUCKET_DAYS))).strftime("%Y-%m-%d")
+    moved = {}
+
+    try:
+        with open(ARCHIVE_JOURNAL_PATH, encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        job = None
+    if job:
+        print(f"🔁 Finishing interrupted archive of '{job['tab']}' (stage {job['stage']}).")
+        if job["stage"] == "writing":
+            _archive_write(job["tab"], job["header"], job["months"], skip_existing=True)
+        moved[job["tab"]] = _archive_finish(job)
+
+    for tab in ARCHIVE_TABS:
+        limit = _archive_row_limit(tab)
+        if not limit or tab in moved:  # تبی که همین حالا تکمیل شد در اجرای بعد
+            continue
+        ws = ss.worksheet(tab)
+        head = [c.strip() for c in ws.row_values(1)]
+        col = next((head.index(a) for a in COLUMN_ALIASES["date"] if a in head), None)
+        if col is None:
+            continue
+        # اول فقط ستون تاریخ؛ کل تب فقط وقتی خوانده می‌شود که ردیفی برای بایگانی باشد
+        dates = ws.col_values(col + 1)[1:limit + 1]
+        parser = DateParser(sample=dates)
+        if not any(d and d.strftime("%Y-%m-%d") < cutoff for d in (parse_date_hour(v, "", parser, tab)[0] for v in dates)):
+            continue
+
+        grid = ws.get_all_values()
+        width = max(len(r) for r in grid)
+        header = list(grid[0]) + [""] * (width - len(grid[0]))
+        months = defaultdict(list)
+        for r, fp in zip(grid[1:limit + 1], archive_fps(tab, grid[1:])):
+            dt = parse_date_hour(r[col] if col < len(r) else "", "", parser, tab)[0]
+            if dt and dt.strftime("%Y-%m-%d") < cutoff:
+                months[dt.strftime("%Y-%m")].append((fp, r))
+        if not months:
+            continue
+        job = {"tab": tab, "header": header, "stage": "writing", "months": months}
+        _archive_journal_save(job)
+        _archive_write(tab, header, months)
+        job["stage"] = "written"
+        _archive_journal_save(job)
+        moved[tab] = _archive_finish(job)
+
+    if moved:
+        run_stats["archived"] = moved
+        emit_event("archive", cutoff=cutoff, target=ARCHIVE_TARGET, tabs=moved)
+        print(f"✅ Archived {sum(moved.values())} rows older than {cutoff} "
+              f"({', '.join(f'{t}: {n}' for t, n in moved.items())}).")
 
 # ---------------------------
 # درج نهایی
 # ---------------------------
+mark_stage("append")
+new_rows = [r.cells() for r in new_rows]  # قالب‌بندی سلول‌ها فقط همین‌جا، درست قبل از نوشتن
+if DEDUP_MODE == "bloom":
+    run_stats["dedup"] = {"keys": existing_keys_hour.stats, "presort": existing_presort_hour.stats}
+for _r in new_rows:
+    run_stats["rows_emitted"][_r[1]] = run_stats["rows_emitted"].get(_r[1], 0) + 1
+
+emit_event("rows_emitted", rows=len(new_rows), by_task=run_stats["rows_emitted"])
+print_error_summary()
+
+# ژورنال همیشه باز می‌شود تا مراحل بعدی (و باقی‌ماندهٔ اجرای قبل) تا پایان کار در آن ثبت باشند
+journal_begin(new_rows, all_data_count + 1, APPEND_CHUNK_ROWS, carry=journal_carry)
 if new_rows:
-    ws_all.append_rows(new_rows, value_input_option="RAW")
+    n_chunks = (len(new_rows) + APPEND_CHUNK_ROWS - 1) // APPEND_CHUNK_ROWS
+    for n, i in enumerate(range(0, len(new_rows), APPEND_CHUNK_ROWS), start=1):
+        chunk = new_rows[i:i + APPEND_CHUNK_ROWS]
+        emit_event("append_chunk", chunk=n, of=n_chunks, rows=len(chunk))
+        journal_mark(n, "writing")
+        ws_all.append_rows(chunk, value_input_option="RAW")
+        journal_mark(n, "committed")
+    all_data_count += len(new_rows)
+    if vals_all is not None:
+        vals_all.extend(new_rows)
     print(f"✅ Added {len(new_rows)} new rows.")
 else:
     print("ℹ️ No new rows to add.")
 
+mark_stage("hour_buckets")
+try:
+    bucket_new = apply_bucket_updates()
+    save_bucket_state(bucket_state, bucket_horizon, force_only if overrides_ok else None)
+except Exception as e:
+    print(f"❌ Hour bucket update error: {e}")
+    bucket_new = []
+
+mark_stage("kpi_backfill")
+try:
+    backfilled_rows = kpi_backfill()
+except Exception as e:
+    print(f"❌ KPI backfill error: {e}")
+    backfilled_rows = []
+
+# ردیف‌های اضافه‌شده و ردیف‌های بازنویسی‌شده (مجموع ساعتی / KPI): تاریخ‌هایشان دوباره export و rollup می‌شوند.
+# هر مرحله فقط بعد از موفقیت در ژورنال done می‌شود؛ مرحلهٔ ناموفق در اجرای بعد با همین ردیف‌ها تکرار می‌شود.
+touched_rows = new_rows + bucket_new + backfilled_rows
+stages_ok = True
+for _stage_name, _stage_fn in (("export", export_rows_columnar), ("rollups", update_rollups),
+                               ("records_log", update_records_log)):
+    mark_stage(_stage_name)
+    if _stage_fn(journal_carry.get(_stage_name, []) + touched_rows):
+        journal_stage(_stage_name)
+    else:
+        stages_ok = False
+if stages_ok:
+    journal_done()
+
+mark_stage("archive")
+try:
+    archive_source_tabs()
+except Exception as e:
+    print(f"❌ Archive error: {e}")
+
 sys.exit(0)
 
 # ====== تکرار عین کدِ بالا طبق فایل ارسالی شما (فقط همین تغییر کوچکِ Shift3 و فیلتر Receive دوباره اعمال شده) ======
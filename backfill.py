@@ -0,0 +1,357 @@
+# backfill.py — rebuild All_Data for a date range, one day per worker process
+# -*- coding: utf-8 -*-
+#
+#   python backfill.py 2024-01-01 2024-01-31                      # fill missing rows from the live tabs
+#   python backfill.py 2024-01-01 2024-01-31 --mode rebuild       # replace the range in All_Data
+#   python backfill.py 2024-01-01 2024-01-31 --source snapshot:/data/snapshots@<id> --mode dry-run --out rows.jsonl
+#
+# Each day is run through All_Data.py itself (against an in-process sheets_emulator.py
+# holding that day's rows), so every rule — presort exclusivity, Larg_Overrides,
+# Other Work, KPI — is exactly the pipeline's. Hours never span two days.
+# Rows All_Data.py moved to its archive (ARCHIVE_TARGET / ARCHIVE_DIR, same settings)
+# are read back for the months of the range, so a rebuild never drops archived days.
+import os, sys, json, time, fcntl, socket, argparse, tempfile, threading, subprocess
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from common import (
+    HEADERS, LOCK_PATH, RULES_TAB, SCOPES, SPREADSHEET_ID, SHEETS_EMULATOR_URL, service_account_client, emulator_client,
+    norm_date_str, _parse_excel_serial, dedup_keys_for_rows, DateParser, SnapshotStore,
+    ArchiveStore, archive_fps, delete_sheet_rows,
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# تب‌هایی که بر اساس تاریخ ردیف تقسیم می‌شوند / تب‌هایی که کامل به هر روز داده می‌شوند
+SOURCE_TABS = ["Receive", "Locate", "Sort", "Pack", "Stock taking", "Pick", "Presort"]
+SHARED_TABS = ["KPI_Config", "Other Work", "Larg_Overrides", RULES_TAB]
+PRESORT_TYPES = {"Presort", "Presort_Larg"}  # مثل All_Data.py
+
+try:
+    APPEND_CHUNK_ROWS = max(1, int(os.getenv("APPEND_CHUNK_ROWS", "5000")))
+except:
+    APPEND_CHUNK_ROWS = 5000
+try:
+    DAY_TIMEOUT = int(os.getenv("BACKFILL_DAY_TIMEOUT", "900"))
+except:
+    DAY_TIMEOUT = 900
+DELETE_BATCH = 500  # deleteDimension در هر batchUpdate
+
+# بایگانی All_Data.py (همان متغیرها و پیش‌فرض‌ها)
+try:
+    ARCHIVE_DAYS = max(0, int(os.getenv("ARCHIVE_DAYS", "0")))
+except:
+    ARCHIVE_DAYS = 0
+try:
+    HOUR_BUCKET_DAYS = max(1, int(os.getenv("HOUR_BUCKET_DAYS", "7")))
+except:
+    HOUR_BUCKET_DAYS = 7
+ARCHIVE_TARGET = os.getenv("ARCHIVE_TARGET", "tabs").strip().lower()
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/tmp/all_data_archive")
+
+# محیط All_Data.py برای یک روز: بدون state، export، rollup، snapshot و بایگانی
+# (ژورنال/پوشهٔ بایگانی هم داخل پوشهٔ موقت همان روز، نه فایل‌های pipeline اصلی)
+DAY_ENV = {
+    "RECORDS_PATH": "", "JOURNAL_PATH": "", "KPI_STATE_PATH": "", "HOUR_BUCKETS_PATH": "",
+    "SNAPSHOT_DIR": "", "EXPORT_DIR": "", "ROLLUP_TAB": "", "RUN_EVENTS_PATH": "",
+    "RUN_PROFILE_DIR": "", "DEDUP_MODE": "set", "KEYS_WORKERS": "0", "ERROR_PRINT_LIMIT": "0",
+    "ARCHIVE_DAYS": "0", "ARCHIVE_TARGET": "local",
+}
+
+# ---------------------------
+# ورودی: شیت زنده یا snapshot
+# ---------------------------
+def open_spreadsheet():
+    gc = emulator_client(SHEETS_EMULATOR_URL) if SHEETS_EMULATOR_URL else service_account_client(SCOPES)
+    return gc.open_by_key(SPREADSHEET_ID)
+
+def load_tabs(source):
+    """{title: grid} of SOURCE_TABS + SHARED_TABS from 'live' or 'snapshot:DIR[@id]'."""
+    wanted = SOURCE_TABS + SHARED_TABS
+    if source == "live":
+        ss = open_spreadsheet()
+        present = {ws.title: ws for ws in ss.worksheets()}
+        return {t: present[t].get_all_values() for t in wanted if t in present}
+
+    root, _, ref = source.partition(":")[2].partition("@")
+    store = SnapshotStore(root or os.getenv("SNAPSHOT_DIR", ""))
+    man = store.manifest(ref or "latest")
+    tabs = {}
+    for t, e in man["tabs"].items():
+        if t not in wanted:
+            continue
+        if e.get("first_row"):
+            raise ValueError(f"Snapshot {man['id']} only has rows from {e['first_row']} on for '{t}'.")
+        tabs[t] = store.get(e["sha256"])
+    print(f"ℹ️ Loaded snapshot {man['id']} ({len(tabs)} tabs).")
+    return tabs
+
+def _months(start, end):
+    out, (y, m) = [], (int(start[:4]), int(start[5:7]))
+    while f"{y:04d}-{m:02d}" <= end[:7]:
+        out.append(f"{y:04d}-{m:02d}")
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return out
+
+def read_archive(start, end):
+    """{tab: [(header, [(fingerprint, row)])]} archived by All_Data.py in the months of [start, end]."""
+    months = _months(start, end)
+    out = defaultdict(list)
+    if ARCHIVE_TARGET == "local":
+        store = ArchiveStore(ARCHIVE_DIR)
+        for t in SOURCE_TABS:
+            for m in months:
+                header, items = store.read(t, m)
+                if items:
+                    out[t].append((header, items))
+        return out
+    titles = {f"{t} Archive {m}": t for t in SOURCE_TABS for m in months}
+    for ws in open_spreadsheet().worksheets():
+        t = titles.get(ws.title)
+        if t is None:
+            continue
+        grid = ws.get_all_values()
+        if not grid or "_fingerprint" not in grid[0]:
+            continue
+        i = grid[0].index("_fingerprint")
+        out[t].append((grid[0][:i], [(r[i], r[:i]) for r in grid[1:] if len(r) > i and r[i]]))
+    return out
+
+def merge_archive(tabs, archived):
+    """
+    Appends archived rows to the tab grids, columns matched by header name. Rows
+    still in the grid (snapshot taken before archiving, interrupted archive) are
+    recognised by fingerprint and not added twice. -> rows added
+    """
+    added = 0
+    for t, parts in archived.items():
+        grid = tabs.setdefault(t, [])
+        if not grid:
+            grid.append(list(parts[0][0]))
+        head = [str(c).strip() for c in grid[0]]
+        have = set(archive_fps(t, grid[1:]))
+        for header, items in parts:
+            pos = {str(h).strip(): i for i, h in enumerate(header) if str(h).strip()}
+            idx = [pos.get(h) if h else None for h in head]
+            for fp, r in items:
+                if fp in have:
+                    continue
+                have.add(fp)
+                grid.append([r[i] if i is not None and i < len(r) else "" for i in idx])
+                added += 1
+    return added
+
+def _row_day(v, parser):
+    if isinstance(v, (int, float)) and float(v) > 30000:
+        return _parse_excel_serial(v).strftime("%Y-%m-%d")
+    if isinstance(v, str) and v.strip():
+        dt = parser.parse(v)
+        return dt.strftime("%Y-%m-%d") if dt else None
+    return None
+
+def split_by_day(tabs, start, end):
+    """{day: {tab: [header] + rows of that day}} for days in [start, end]."""
+    days = defaultdict(dict)
+    for t in SOURCE_TABS:
+        grid = tabs.get(t) or []
+        if len(grid) < 2:
+            continue
+        head = [str(c).strip() for c in grid[0]]
+        col = next((head.index(c) for c in ("date", "Date") if c in head), None)
+        if col is None:
+            print(f"⚠️ '{t}' has no date column; skipped.")
+            continue
+        parser = DateParser(sample=(r[col] for r in grid[1:] if len(r) > col))
+        for r in grid[1:]:
+            d = _row_day(r[col], parser) if len(r) > col else None
+            if d and start <= d <= end:
+                days[d].setdefault(t, [grid[0]]).append(r)
+    return days
+
+# ---------------------------
+# پردازش یک روز (در worker process)
+# ---------------------------
+def run_day(day, day_tabs, shared):
+    """Runs All_Data.py on one day's rows; returns (day, All_Data rows, rows_dropped)."""
+    import sheets_emulator as emu
+    emu.EMU_LATENCY_MS = emu.EMU_JITTER_MS = emu.EMU_LATENCY_PER_KB_MS = emu.EMU_429_RATE = 0
+    emu.EMU_QUOTA_PER_MINUTE = emu.EMU_MAX_RESPONSE_BYTES = 0
+
+    wb = emu.Workbook(dict(shared, **day_tabs, All_Data=[list(HEADERS)]))
+    httpd, _ = emu.serve(wb, "127.0.0.1", 0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"backfill-{day}-") as tmp:
+            stats_path = os.path.join(tmp, "stats.json")
+            env = dict(os.environ, **DAY_ENV,
+                       SHEETS_EMULATOR_URL=f"http://127.0.0.1:{httpd.server_address[1]}",
+                       RUN_STATS_PATH=stats_path,
+                       ARCHIVE_JOURNAL_PATH=os.path.join(tmp, "archive_journal.json"),
+                       ARCHIVE_DIR=os.path.join(tmp, "archive"))
+            p = subprocess.run([sys.executable, os.path.join(HERE, "All_Data.py")], cwd=tmp, env=env,
+                               capture_output=True, text=True, timeout=DAY_TIMEOUT)
+            if p.returncode != 0:
+                tail = ((p.stdout or "") + (p.stderr or "")).strip()[-1500:]
+                raise RuntimeError(f"All_Data.py exited {p.returncode} for {day}:\n{tail}")
+            try:
+                with open(stats_path, encoding="utf-8") as f:
+                    dropped = json.load(f).get("rows_dropped", {})
+            except (OSError, ValueError):
+                dropped = {}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    rows = [list(r) + [""] * (len(HEADERS) - len(r)) for r in wb.sheets["All_Data"]["rows"][1:] if r]
+    return day, rows, dropped
+
+def _sort_key(r):
+    try:
+        hour = int(float(r[4]))
+    except (TypeError, ValueError):
+        hour = -1
+    return (r[3], hour, r[0], r[1])
+
+def run_days(days, shared, workers):
+    """All days through a process pool; merged in (date, hour, name, task) order."""
+    out, dropped = {}, defaultdict(int)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futs = {pool.submit(run_day, d, days[d], shared): d for d in sorted(days)}
+        for fut in as_completed(futs):
+            day, rows, drops = fut.result()
+            out[day] = rows
+            for k, v in drops.items():
+                dropped[k] += v
+            print(f"  {day}: {len(rows)} rows")
+    merged = [r for d in sorted(out) for r in sorted(out[d], key=_sort_key)]
+    return merged, dict(dropped)
+
+# ---------------------------
+# نوشتن در All_Data (چند تکه)
+# ---------------------------
+class BackfillLock:
+    """Exclusive flock on LOCK_PATH, so a scheduled pipeline run cannot interleave."""
+
+    def __enter__(self):
+        self.fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.fd)
+            raise RuntimeError(f"A pipeline run holds {LOCK_PATH}; try again later.")
+        info = {"pid": os.getpid(), "host": socket.gethostname(), "started_at": time.time(),
+                "heartbeat_at": time.time(), "trigger": "backfill"}
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, json.dumps(info).encode("utf-8"), 0)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            os.ftruncate(self.fd, 0)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+
+def append_chunks(ws, rows):
+    for i in range(0, len(rows), APPEND_CHUNK_ROWS):
+        ws.append_rows(rows[i:i + APPEND_CHUNK_ROWS], value_input_option="RAW")
+        print(f"  appended {min(i + APPEND_CHUNK_ROWS, len(rows))}/{len(rows)}")
+
+def write_fill(ws, existing, rows):
+    keys, presort = dedup_keys_for_rows(existing[1:], PRESORT_TYPES)
+    todo = []
+    for r in rows:
+        k, p = dedup_keys_for_rows([r], PRESORT_TYPES)
+        if k & keys or p & presort:
+            continue
+        keys |= k
+        presort |= p
+        todo.append(r)
+    print(f"ℹ️ {len(rows) - len(todo)} rows already in All_Data; appending {len(todo)}.")
+    append_chunks(ws, todo)
+    return len(todo)
+
+def write_rebuild(ss, ws, existing, rows, start, end):
+    # اول append و بعد حذف: قطع شدن وسط کار فقط تکرار می‌سازد که اجرای دوباره پاکش می‌کند
+    old = [n for n, r in enumerate(existing[1:], start=2)
+           if len(r) > 3 and start <= norm_date_str(r[3]) <= end]
+    append_chunks(ws, rows)
+    spans = delete_sheet_rows(ss, ws, old, DELETE_BATCH)
+    print(f"ℹ️ Replaced {len(old)} rows ({spans} ranges) with {len(rows)} rebuilt rows.")
+    return len(rows)
+
+# ---------------------------
+# main
+# ---------------------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Rebuild All_Data rows for a date range, one day per process.")
+    ap.add_argument("start", help="YYYY-MM-DD (inclusive)")
+    ap.add_argument("end", help="YYYY-MM-DD (inclusive)")
+    ap.add_argument("--source", default="live", help="live | snapshot:DIR[@id] (default: live)")
+    ap.add_argument("--mode", default="fill", choices=["fill", "rebuild", "dry-run"],
+                    help="fill: append missing rows; rebuild: replace the range; dry-run: no writes")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    ap.add_argument("--out", help="also write the merged rows here (JSON per line)")
+    args = ap.parse_args(argv)
+
+    start = datetime.strptime(args.start, "%Y-%m-%d").strftime("%Y-%m-%d")
+    end = datetime.strptime(args.end, "%Y-%m-%d").strftime("%Y-%m-%d")
+    t0 = time.time()
+
+    # بدون ردیف‌های بایگانی‌شده، rebuild روزهای بایگانی‌شده را از All_Data پاک می‌کرد
+    cutoff = (datetime.now() - timedelta(days=max(ARCHIVE_DAYS, HOUR_BUCKET_DAYS))).strftime("%Y-%m-%d")
+    if (args.mode == "rebuild" and ARCHIVE_DAYS > 0 and start < cutoff
+            and ARCHIVE_TARGET == "local" and not os.path.isdir(ARCHIVE_DIR)):
+        raise RuntimeError(f"Range starts before the archive cutoff {cutoff} but ARCHIVE_DIR "
+                           f"{ARCHIVE_DIR} does not exist here; refusing to rebuild without the archived rows.")
+
+    tabs = load_tabs(args.source)
+    try:
+        archived = read_archive(start, end)
+    except Exception as e:
+        if args.mode == "rebuild":
+            raise RuntimeError(f"Archive read failed ({e}); refusing to rebuild without the archived rows.")
+        print(f"⚠️ Archive not read: {e}")
+        archived = {}
+    if archived:
+        print(f"ℹ️ {merge_archive(tabs, archived)} archived rows added from {ARCHIVE_TARGET} archive.")
+    shared = {t: tabs[t] for t in SHARED_TABS if t in tabs}
+    days = split_by_day(tabs, start, end)
+    del tabs
+    print(f"ℹ️ {len(days)} days with source rows in {start}..{end}; {args.workers} workers.")
+
+    rows, dropped = run_days(days, shared, max(1, args.workers))
+    print(f"ℹ️ {len(rows)} rows computed in {time.time() - t0:.1f}s.")
+    if dropped:
+        top = sorted(dropped.items(), key=lambda kv: kv[1], reverse=True)[:10]
+        print("ℹ️ Dropped: " + ", ".join(f"{k} ×{v}" for k, v in top))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        print(f"ℹ️ Wrote {len(rows)} rows to {args.out}.")
+    if args.mode == "dry-run":
+        return 0
+
+    with BackfillLock():
+        ss = open_spreadsheet()
+        ws = ss.worksheet("All_Data")
+        existing = ws.get_all_values()
+        if args.mode == "fill":
+            n = write_fill(ws, existing, rows)
+        else:
+            n = write_rebuild(ss, ws, existing, rows, start, end)
+    print(f"✅ Backfill {start}..{end} ({args.mode}): {n} rows written in {time.time() - t0:.1f}s.")
+    if args.mode == "rebuild":
+        print("ℹ️ Rollups and the records log are not rewritten; rebuild them if they cover this range.")
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except Exception as e:
+        print(f"❌ Backfill error: {e}")
+        sys.exit(1)
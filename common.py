@@ -0,0 +1,562 @@
+# common.py — shared by All_Data.py (pipeline) and web.py (service)
+# -*- coding: utf-8 -*-
+import os, re, gzip, json, math, mmap, time, hashlib, sqlite3, unicodedata
+from datetime import datetime, timedelta
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+HEADERS = [
+    'full_name','task_type','quantity','date','hour','occupied_hours','order',
+    'performance_without_rotation','performance_with_rotation','Negative_Minutes',
+    'Ipo_Pack','UserName','Shift'
+]
+
+# خروجی پردازش‌شده (هر خط یک ردیف JSON) که web.py از آن ایندکس می‌سازد (خالی = غیرفعال)
+RECORDS_PATH = os.getenv("RECORDS_PATH", "/tmp/all_data_records.jsonl").strip()
+
+# قفل اجرای پایپ‌لاین — web.py و backfill.py باید دقیقاً همین مسیر را قفل کنند
+LOCK_PATH = os.getenv("LOCK_PATH", "/tmp/all_data.lock").strip()
+# تب قوانین فیلتر (All_Data.py می‌خواند، backfill.py به هر روز کپی می‌کند)
+RULES_TAB = os.getenv("RULES_TAB", "Filter_Rules").strip()
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+SPREADSHEET_ID = os.getenv(
+    "SPREADSHEET_ID",
+    "1VgKCQ8EjVF2sS8rSPdqFZh2h6CuqWAeqSMR56APvwes"
+)
+# آدرس sheets_emulator.py برای تست بار/تأخیر (خالی = Google واقعی)
+SHEETS_EMULATOR_URL = os.getenv("SHEETS_EMULATOR_URL", "").strip().rstrip("/")
+
+def norm_str(x):
+    return "" if x is None else str(x).strip()
+
+# ----- Regex sets for normalization -----
+_ZW_RE = re.compile(r"[\u200c\u200d\u200e\u200f\u202a-\u202e\u2066-\u2069\u061c\uFEFF]")
+_ARABIC_DIAC = re.compile(r"[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]")
+
+def norm_name(s: str) -> str:
+    if s is None:
+        return ""
+    s = unicodedata.normalize("NFKC", str(s))
+    s = s.replace("ي", "ی").replace("ى", "ی").replace("ې", "ی").replace("ك", "ک")
+    s = _ZW_RE.sub("", s)
+    s = _ARABIC_DIAC.sub("", s)
+    s = s.replace("\u200c", " ")
+    s = s.replace("\u00A0", " ").replace("\t", " ").replace("\r", " ").replace("\n", " ")
+    s = s.replace("\u0640", "")
+    s = re.sub(r"\s+", " ", s).strip()
+    return s
+
+def norm_task(s: str) -> str:
+    if s is None:
+        return ""
+    s = unicodedata.normalize("NFKC", str(s))
+    s = _ZW_RE.sub("", s)
+    s = s.replace("\u0640", "")
+    s = re.sub(r"\s+", " ", s).strip()
+    return s
+
+def base_task(task: str) -> str:
+    """Task without the _Larg suffix: one hour is either Pick or Pick_Larg, never both."""
+    return task[:-len("_Larg")] if task.endswith("_Larg") else task
+
+# ---------------------------
+# gspread clients (import تنبل تا web.py بدون gspread هم بالا بیاید)
+# ---------------------------
+def service_account_client(scopes=SCOPES):
+    """GOOGLE_CREDENTIALS (service-account JSON in ENV) or credentials.json."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+    env_creds = os.getenv("GOOGLE_CREDENTIALS")
+    if env_creds:
+        creds = Credentials.from_service_account_info(json.loads(env_creds), scopes=scopes)
+    else:
+        creds = Credentials.from_service_account_file("credentials.json", scopes=scopes)
+    return gspread.authorize(creds)
+
+def emulator_client(url):
+    """Unauthenticated gspread client whose https:// requests all go to `url` (same path/query)."""
+    import gspread, requests
+    base = url.rstrip("/")
+
+    class EmulatorAdapter(requests.adapters.HTTPAdapter):
+        def send(self, request, **kwargs):
+            u = urlsplit(request.url)
+            request.url = base + u.path + (f"?{u.query}" if u.query else "")
+            return super().send(request, **kwargs)
+
+    session = requests.Session()
+    session.mount("https://", EmulatorAdapter())
+    return gspread.Client(None, session=session)
+
+def delete_sheet_rows(ss, ws, row_numbers, batch=500):
+    """Deletes sheet rows (1-based) as contiguous spans, bottom-up so indexes stay valid. -> spans"""
+    spans = []
+    for n in sorted(row_numbers, reverse=True):
+        if spans and spans[-1][0] == n + 1:
+            spans[-1][0] = n
+        else:
+            spans.append([n, n])
+    reqs = [{"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS",
+                                           "startIndex": a - 1, "endIndex": b}}} for a, b in spans]
+    for i in range(0, len(reqs), batch):
+        ss.batch_update({"requests": reqs[i:i + batch]})
+    return len(spans)
+
+# ---------------------------
+# Date parsing engine
+# ---------------------------
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%B %d, %Y", "%m/%d/%Y %H:%M:%S")
+_MISSING = object()
+
+class DateParser:
+    """
+    Date strings of one column. The column's format is detected from a sample
+    and tried first; the other DATE_FORMATS are only tried on a mismatch.
+    Results are memoized per distinct string (a tab has few dates, many rows).
+    The formats never match the same string, so the order does not change results.
+    """
+    MAX_CACHE = 100000
+
+    def __init__(self, sample=None, formats=DATE_FORMATS):
+        self.formats = tuple(formats)
+        self._cache = {}
+        self._iso = {}
+        if sample is not None:
+            self.detect(sample)
+
+    def detect(self, values, limit=200):
+        hits = dict.fromkeys(self.formats, 0)
+        seen = 0
+        for v in values:
+            if not isinstance(v, str) or not v.strip():
+                continue
+            s = v.strip()
+            for fmt in self.formats:
+                try:
+                    datetime.strptime(s, fmt)
+                except ValueError:
+                    continue
+                hits[fmt] += 1
+                break
+            seen += 1
+            if seen >= limit:
+                break
+        best = max(self.formats, key=lambda f: hits[f])
+        if hits[best]:
+            self.formats = (best,) + tuple(f for f in self.formats if f != best)
+        return self
+
+    def parse(self, s):
+        dt = self._cache.get(s, _MISSING)
+        if dt is not _MISSING:
+            return dt
+        dt = None
+        t = s.strip()
+        for fmt in self.formats:
+            try:
+                dt = datetime.strptime(t, fmt)
+                break
+            except ValueError:
+                continue
+        if len(self._cache) >= self.MAX_CACHE:
+            self._cache.clear()
+        self._cache[s] = dt
+        return dt
+
+    def iso(self, s):
+        out = self._iso.get(s)
+        if out is None:
+            dt = self.parse(s)
+            out = dt.strftime("%Y-%m-%d") if dt else s.strip()
+            if len(self._iso) >= self.MAX_CACHE:
+                self._iso.clear()
+            self._iso[s] = out
+        return out
+
+DEFAULT_DATE_PARSER = DateParser()
+
+def norm_date_str(dt):
+    if dt is None or dt == "":
+        return ""
+    if hasattr(dt, "strftime"):
+        return dt.strftime("%Y-%m-%d")
+    return DEFAULT_DATE_PARSER.iso(str(dt))
+
+def _parse_excel_serial(val):
+    return datetime(1899, 12, 30) + timedelta(days=float(val))
+
+@lru_cache(maxsize=65536)
+def norm_hour_key(x):
+    if x is None or x == "":
+        return ""
+    try:
+        f = float(x)
+        i = int(f)
+        if 0 <= i <= 23:
+            return str(i)
+        return str(_parse_excel_serial(f).hour)
+    except:
+        s = str(x).strip()
+        if s.isdigit():
+            return s
+        try:
+            return str(_parse_excel_serial(float(s)).hour)
+        except:
+            return s
+
+# ---------------------------
+# کلیدهای dedup از ردیف‌های All_Data (مشترک بین All_Data.py و backfill.py)
+# ---------------------------
+def dedup_keys_for_rows(rows, presort_types):
+    keys, presort = set(), set()
+    for r in rows:
+        full_name = norm_name(r[0] if len(r)>0 else "")
+        task_type = norm_task(r[1] if len(r)>1 else "")
+        dt        = norm_date_str(r[3] if len(r)>3 else "")
+        hr_raw    = r[4] if len(r)>4 else ""
+        hr_key    = norm_hour_key(hr_raw)
+        if full_name and dt != "" and hr_key != "":
+            keys.add(f"{full_name}||{task_type}||{dt}||{hr_key}")
+            if task_type in presort_types:
+                presort.add((full_name, dt, hr_key))
+    return keys, presort
+
+# ---------------------------
+# Bounded-memory dedup: Bloom filter در حافظه + ایندکس دقیق SQLite روی دیسک
+# ---------------------------
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001, bits=None):
+        self.capacity = int(capacity)
+        self.error_rate = error_rate
+        self.m = max(64, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.k = max(1, round(self.m / self.capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.m + 7) // 8)
+
+    def _positions(self, key):
+        d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def add(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class KeyStore:
+    """
+    Persisted dedup keys in `path`. The Bloom filter answers most probes (new rows
+    are mostly new keys); only filter hits are verified against the SQLite index.
+    add() keeps this run's keys in memory; index() stores keys read back from
+    All_Data, so the store never holds a key that did not land in the sheet.
+    """
+
+    def __init__(self, path, capacity=5_000_000, error_rate=0.001):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, "meta.json")
+        self._bloom_path = os.path.join(path, "bloom.bin")
+        try:
+            with open(self._meta_path, encoding="utf-8") as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError):
+            self.meta = {}
+        self.error_rate = error_rate
+        cap = max(int(self.meta.get("capacity") or 0), int(capacity))
+        bits = None
+        if self.meta.get("capacity") == cap and os.path.exists(self._bloom_path):
+            with open(self._bloom_path, "rb") as f:
+                bits = bytearray(f.read())
+        self.bloom = BloomFilter(cap, error_rate, bits)
+        self.db = sqlite3.connect(os.path.join(path, "keys.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS keys (k TEXT PRIMARY KEY) WITHOUT ROWID")
+        if not self.meta:
+            self.reset()
+        elif bits is None or len(bits) != len(self.bloom.bits):
+            # ظرفیت عوض شده یا فایل filter نیست/خراب است: کلیدهای ذخیره‌شده با همان watermark دوباره وارد filter می‌شوند
+            self._rebuild(cap)
+        self._pending = set()
+        self.stats = {"probes": 0, "filter_hits": 0, "verified": 0}
+
+    @staticmethod
+    def _k(key):
+        return "||".join(map(str, key)) if isinstance(key, tuple) else key
+
+    @property
+    def watermark(self):
+        return int(self.meta.get("watermark") or 0)
+
+    @property
+    def fingerprint(self):
+        return self.meta.get("fingerprint")
+
+    def __contains__(self, key):
+        key = self._k(key)
+        self.stats["probes"] += 1
+        if key in self._pending:
+            return True
+        if key not in self.bloom:
+            return False
+        self.stats["filter_hits"] += 1
+        hit = self.db.execute("SELECT 1 FROM keys WHERE k = ?", (key,)).fetchone() is not None
+        if hit:
+            self.stats["verified"] += 1
+        return hit
+
+    def add(self, key):
+        self._pending.add(self._k(key))
+
+    def index(self, keys):
+        keys = [self._k(k) for k in keys]
+        for k in keys:
+            self.bloom.add(k)
+        cur = self.db.executemany("INSERT OR IGNORE INTO keys VALUES (?)", ((k,) for k in keys))
+        self.meta["count"] = int(self.meta.get("count") or 0) + max(cur.rowcount, 0)
+
+    def reset(self):
+        self.db.execute("DELETE FROM keys")
+        self.bloom = BloomFilter(self.bloom.capacity, self.error_rate)
+        self.meta = {"capacity": self.bloom.capacity, "count": 0, "watermark": 0, "fingerprint": None}
+
+    def _rebuild(self, cap):
+        # کلیدها از SQLite به صورت جریانی دوباره وارد filter می‌شوند
+        self.bloom = BloomFilter(cap, self.error_rate)
+        for (k,) in self.db.execute("SELECT k FROM keys"):
+            self.bloom.add(k)
+        self.meta["capacity"] = cap
+
+    def _grow(self):
+        # ظرفیت دو برابر
+        cap = self.bloom.capacity
+        while self.meta["count"] > cap:
+            cap *= 2
+        self._rebuild(cap)
+
+    def save(self, watermark, fingerprint):
+        self.db.commit()
+        if self.meta["count"] > self.bloom.capacity:
+            self._grow()
+        tmp = self._bloom_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.bloom.bits)
+        os.replace(tmp, self._bloom_path)
+        self.meta.update({"capacity": self.bloom.capacity, "watermark": watermark, "fingerprint": fingerprint})
+        tmp = self._meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self._meta_path)
+
+
+# ---------------------------
+# قوانین فیلتر: پیشوندهای مجاز/ممنوع و لیست حذف روی مقدار نرمال‌شده، در یک trie
+# ---------------------------
+_PREFIX = ""    # node[_PREFIX] -> verdict of the prefix ending at this node
+_EXACT = None   # node[_EXACT] -> True when the whole value is excluded
+
+class PrefixRules:
+    """
+    Allow/deny prefixes and exact exclusions compiled into one character trie.
+    The longest matching prefix decides; a value no prefix matches passes only
+    when there are no allow prefixes. Verdicts are memoized per distinct raw value.
+    """
+
+    def __init__(self, allow=(), deny=(), exclude=(), norm=norm_name):
+        self.norm = norm
+        self.root = {}
+        self.has_allow = False
+        for verdict, values in ((True, allow), (False, deny)):
+            for v in values:
+                v = norm(v)
+                if v:
+                    self._node(v)[_PREFIX] = verdict
+                    self.has_allow = self.has_allow or verdict
+        for v in exclude:
+            v = norm(v)
+            if v:
+                self._node(v)[_EXACT] = True
+        self._verdicts = {}
+
+    def _node(self, s):
+        node = self.root
+        for ch in s:
+            node = node.setdefault(ch, {})
+        return node
+
+    def _match(self, s):
+        ok = not self.has_allow
+        node = self.root
+        for ch in s:
+            node = node.get(ch)
+            if node is None:
+                return ok
+            ok = node.get(_PREFIX, ok)
+        return ok and not node.get(_EXACT)
+
+    def __call__(self, raw):
+        try:
+            return self._verdicts[raw]
+        except KeyError:
+            s = self.norm(raw)
+            ok = self._verdicts[raw] = self._match(s) if s else not self.has_allow
+            return ok
+
+    @property
+    def distinct(self):
+        return len(self._verdicts)
+
+
+# ---------------------------
+# Snapshot store: گریدهای خام تب‌ها (gzip JSON با نام sha256) + یک manifest برای هر اجرا
+# ---------------------------
+class SnapshotStore:
+    """
+    root/objects/ab/<sha256>.json.gz holds one tab grid; a tab that did not change
+    between runs hashes to the same object and is stored once.
+    root/manifests/<id>.json maps tab titles of one run to their objects.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.manifests = os.path.join(root, "manifests")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.manifests, exist_ok=True)
+
+    def _obj_path(self, sha):
+        return os.path.join(self.objects, sha[:2], sha + ".json.gz")
+
+    def put(self, grid):
+        """-> (sha256, bytes written; 0 when the object already existed)"""
+        raw = json.dumps(grid, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        sha = hashlib.sha256(raw).hexdigest()
+        path = self._obj_path(sha)
+        if os.path.exists(path):
+            return sha, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(gzip.compress(raw, compresslevel=6, mtime=0))
+        os.replace(tmp, path)
+        return sha, os.path.getsize(path)
+
+    def get(self, sha):
+        with open(self._obj_path(sha), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return json.loads(gzip.decompress(m))
+
+    def manifest_ids(self):
+        return sorted(n[:-5] for n in os.listdir(self.manifests) if n.endswith(".json"))
+
+    def manifest(self, ref="latest"):
+        if ref in ("", "latest"):
+            ids = self.manifest_ids()
+            if not ids:
+                raise FileNotFoundError(f"No snapshots in {self.root}")
+            ref = ids[-1]
+        with open(os.path.join(self.manifests, ref + ".json"), encoding="utf-8") as f:
+            man = json.load(f)
+        man["id"] = ref
+        return man
+
+    def save_manifest(self, tabs, **meta):
+        sid = time.strftime("%Y%m%dT%H%M%S", time.gmtime()) + f"-{os.getpid()}"
+        path = os.path.join(self.manifests, sid + ".json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(meta, created_at=time.time(), tabs=tabs), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        return sid
+
+    def load(self, ref="latest", tabs=None):
+        """{title: grid} of one snapshot (all tabs, or only `tabs`)."""
+        man = self.manifest(ref)
+        return {t: self.get(e["sha256"]) for t, e in man["tabs"].items() if tabs is None or t in tabs}
+
+    def prune(self, keep):
+        """Keeps the newest `keep` manifests and the objects they reference."""
+        ids = self.manifest_ids()
+        for sid in ids[:-keep] if keep > 0 else []:
+            os.remove(os.path.join(self.manifests, sid + ".json"))
+        live = set()
+        for sid in self.manifest_ids():
+            for e in self.manifest(sid)["tabs"].values():
+                live.add(e["sha256"])
+                if e.get("after_archive"):
+                    live.add(e["after_archive"])
+        removed = 0
+        for d in os.listdir(self.objects):
+            for n in os.listdir(os.path.join(self.objects, d)):
+                if n.endswith(".json.gz") and n[:-8] not in live:
+                    os.remove(os.path.join(self.objects, d, n))
+                    removed += 1
+        return removed
+
+
+# ---------------------------
+# Archive store: ردیف‌های بایگانی‌شدهٔ تب‌های ورودی، یک فایل gzip JSONL برای هر (تب، ماه)
+# ---------------------------
+class ArchiveStore:
+    """
+    root/<tab>/<YYYY-MM>.jsonl.gz: a {"header": [...]} line, then one
+    {"fp": fingerprint, "row": [...]} line per archived row. Every append
+    adds a gzip member, so a file is only ever appended to.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, tab, month):
+        return os.path.join(self.root, tab, f"{month}.jsonl.gz")
+
+    def append(self, tab, month, header, items):
+        """items: [(fingerprint, row)]"""
+        path = self._path(tab, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = [] if os.path.exists(path) else [{"header": list(header)}]
+        lines += [{"fp": fp, "row": list(r)} for fp, r in items]
+        with open(path, "ab") as f:
+            f.write(gzip.compress("".join(json.dumps(o, ensure_ascii=False) + "\n" for o in lines).encode("utf-8")))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, tab, month):
+        """-> (header, [(fingerprint, row)])"""
+        path = self._path(tab, month)
+        if not os.path.exists(path):
+            return [], []
+        header, items = [], []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                o = json.loads(line)
+                if "header" in o:
+                    header = o["header"]
+                else:
+                    items.append((o["fp"], o["row"]))
+        return header, items
+
+    def fingerprints(self, tab, month):
+        return {fp for fp, _ in self.read(tab, month)[1]}
+
+def archive_fps(tab, rows):
+    """Row fingerprints; the n-th copy of an identical row gets "-n" so copies stay distinct."""
+    seen, out = {}, []
+    for r in rows:
+        r = list(r)
+        while r and r[-1] == "":
+            r.pop()
+        fp = hashlib.sha1(json.dumps([tab] + r, ensure_ascii=False).encode("utf-8")).hexdigest()
+        seen[fp] = seen.get(fp, 0) + 1
+        out.append(fp if seen[fp] == 1 else f"{fp}-{seen[fp]}")
+    return out
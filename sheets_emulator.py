@@ -0,0 +1,448 @@
+# sheets_emulator.py — local stand-in for the part of the Sheets v4 API that All_Data.py uses
+# -*- coding: utf-8 -*-
+#
+#   EMU_DATA=fixture.json python sheets_emulator.py
+#   SHEETS_EMULATOR_URL=http://127.0.0.1:8765 python All_Data.py
+#
+# fixture.json: {"All_Data": [[header...], [row...]], "Pick": [...], ...}
+#
+# Replay of a run from SNAPSHOT_DIR (All_Data starts empty; use fresh HOUR_BUCKETS_PATH/DEDUP_DIR):
+#   EMU_SNAPSHOT=/data/snapshots@20240105T101500-123 python sheets_emulator.py   (@id optional = latest)
+import os, re, json, time, random, threading
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from common import HEADERS, SnapshotStore
+
+# ---------------------------
+# تنظیمات (ENV)
+# ---------------------------
+EMU_HOST = os.getenv("EMU_HOST", "127.0.0.1")
+try:
+    EMU_PORT = int(os.getenv("EMU_PORT", "8765"))
+except:
+    EMU_PORT = 8765
+EMU_DATA = os.getenv("EMU_DATA", "").strip()            # fixture JSON (خالی = داده‌ی ساختگی)
+EMU_SAVE_PATH = os.getenv("EMU_SAVE_PATH", "").strip()  # وضعیت نهایی هنگام خاموش شدن ذخیره شود
+EMU_SNAPSHOT = os.getenv("EMU_SNAPSHOT", "").strip()    # SNAPSHOT_DIR[@manifest-id]
+try:
+    EMU_SEED_ROWS = int(os.getenv("EMU_SEED_ROWS", "2000"))   # ردیف ساختگی برای هر تب ورودی
+except:
+    EMU_SEED_ROWS = 2000
+try:
+    EMU_LATENCY_MS = float(os.getenv("EMU_LATENCY_MS", "150"))       # تأخیر ثابت هر فراخوانی
+    EMU_JITTER_MS = float(os.getenv("EMU_JITTER_MS", "50"))          # + تصادفی بین 0 و این مقدار
+    EMU_LATENCY_PER_KB_MS = float(os.getenv("EMU_LATENCY_PER_KB_MS", "0.05"))  # زمان انتقال
+except:
+    EMU_LATENCY_MS, EMU_JITTER_MS, EMU_LATENCY_PER_KB_MS = 150.0, 50.0, 0.05
+try:
+    EMU_QUOTA_PER_MINUTE = int(os.getenv("EMU_QUOTA_PER_MINUTE", "300"))   # 0 = نامحدود
+    EMU_429_RATE = float(os.getenv("EMU_429_RATE", "0"))                   # احتمال 429 تصادفی
+except:
+    EMU_QUOTA_PER_MINUTE, EMU_429_RATE = 300, 0.0
+try:
+    EMU_MAX_REQUEST_BYTES = int(os.getenv("EMU_MAX_REQUEST_BYTES", str(10 * 1024 * 1024)))
+    EMU_MAX_RESPONSE_BYTES = int(os.getenv("EMU_MAX_RESPONSE_BYTES", "0"))  # 0 = نامحدود
+except:
+    EMU_MAX_REQUEST_BYTES, EMU_MAX_RESPONSE_BYTES = 10 * 1024 * 1024, 0
+
+# ---------------------------
+# A1 ranges
+# ---------------------------
+_A1 = re.compile(r"^([A-Za-z]*)(\d*)$")
+
+def _col_num(letters):
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def _col_letters(n):
+    s = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def parse_range(rng):
+    """
+    "'Tab'!A2:M" -> ("Tab", r0, c0, r1, c1): 0-based start, exclusive end,
+    None where the range is open-ended.
+    """
+    title, a1 = (rng.rsplit("!", 1) + [""])[:2] if "!" in rng else (rng, "")
+    if len(title) > 1 and title[0] == "'" and title[-1] == "'":
+        title = title[1:-1].replace("''", "'")
+    if not a1:
+        return title, 0, 0, None, None
+    parts = a1.split(":")
+    m1, m2 = _A1.match(parts[0]), _A1.match(parts[-1])
+    if not m1 or not m2:
+        raise ValueError(f"Unable to parse range: {rng}")
+    c0 = _col_num(m1[1]) - 1 if m1[1] else 0
+    r0 = int(m1[2]) - 1 if m1[2] else 0
+    c1 = _col_num(m2[1]) if m2[1] else None
+    r1 = int(m2[2]) if m2[2] else None
+    return title, r0, c0, r1, c1
+
+def _a1(title, r0, c0, r1, c1):
+    q = "'" + title.replace("'", "''") + "'"
+    return f"{q}!{_col_letters(c0 + 1)}{r0 + 1}:{_col_letters(max(c1, c0 + 1))}{max(r1, r0 + 1)}"
+
+def _render(v, how):
+    if how == "FORMATTED_VALUE" and isinstance(v, (int, float)) and not isinstance(v, bool):
+        return str(int(v)) if float(v).is_integer() else repr(v)
+    return v
+
+def _trim(block):
+    # API مقادیر خالی انتهای هر ردیف و ردیف‌های خالی انتهایی را برنمی‌گرداند
+    out = []
+    for row in block:
+        row = list(row)
+        while row and row[-1] in ("", None):
+            row.pop()
+        out.append(row)
+    while out and not out[-1]:
+        out.pop()
+    return out
+
+# ---------------------------
+# Workbook (در حافظه)
+# ---------------------------
+class ApiError(Exception):
+    def __init__(self, code, status, message):
+        super().__init__(message)
+        self.code, self.status = code, status
+
+
+class Workbook:
+    def __init__(self, tabs):
+        self.lock = threading.Lock()
+        self.sheets = {}
+        for title, rows in tabs.items():
+            self.add_sheet(title, rows)
+
+    def add_sheet(self, title, rows=None, row_count=1000, col_count=26):
+        if title in self.sheets:
+            raise ApiError(400, "INVALID_ARGUMENT",
+                           f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists.')
+        rows = [list(r) for r in (rows or [])]
+        props = {
+            "sheetId": max((s["props"]["sheetId"] + 1 for s in self.sheets.values()), default=0),
+            "title": title,
+            "index": len(self.sheets),
+            "sheetType": "GRID",
+            "gridProperties": {
+                "rowCount": max(row_count, len(rows)),
+                "columnCount": max([col_count] + [len(r) for r in rows]),
+            },
+        }
+        self.sheets[title] = {"props": props, "rows": rows}
+        return props
+
+    def sheet(self, title):
+        s = self.sheets.get(title)
+        if s is None:
+            raise ApiError(400, "INVALID_ARGUMENT", f"Unable to parse range: {title}")
+        return s
+
+    def by_id(self, sheet_id):
+        for s in self.sheets.values():
+            if s["props"]["sheetId"] == sheet_id:
+                return s
+        raise ApiError(400, "INVALID_ARGUMENT", f"No grid with id: {sheet_id}")
+
+    def metadata(self, sid):
+        return {
+            "spreadsheetId": sid,
+            "properties": {"title": "Sheets emulator", "locale": "en_US", "timeZone": "Asia/Tehran"},
+            "sheets": [{"properties": s["props"]} for s in self.sheets.values()],
+        }
+
+    def get(self, rng, major="ROWS", render="FORMATTED_VALUE"):
+        title, r0, c0, r1, c1 = parse_range(rng)
+        s = self.sheet(title)
+        block = [[_render(v, render) for v in row[c0:c1]] for row in s["rows"][r0:r1]]
+        block = _trim(block)
+        if major == "COLUMNS":
+            width = max((len(r) for r in block), default=0)
+            block = _trim([[r[j] if j < len(r) else "" for r in block] for j in range(width)])
+        out = {"range": _a1(title, r0, c0, r1 or len(s["rows"]), c1 or s["props"]["gridProperties"]["columnCount"]),
+               "majorDimension": major}
+        if block:
+            out["values"] = block
+        return out
+
+    def _write(self, s, r0, c0, values):
+        rows = s["rows"]
+        while len(rows) < r0 + len(values):
+            rows.append([])
+        for i, vals in enumerate(values):
+            row = rows[r0 + i]
+            if len(row) < c0 + len(vals):
+                row.extend([""] * (c0 + len(vals) - len(row)))
+            row[c0:c0 + len(vals)] = vals
+        grid = s["props"]["gridProperties"]
+        grid["rowCount"] = max(grid["rowCount"], len(rows))
+        grid["columnCount"] = max(grid["columnCount"], c0 + max((len(v) for v in values), default=0))
+
+    def update(self, rng, values):
+        title, r0, c0, _, _ = parse_range(rng)
+        s = self.sheet(title)
+        self._write(s, r0, c0, values)
+        width = max((len(v) for v in values), default=0)
+        return {"updatedRange": _a1(title, r0, c0, r0 + len(values), c0 + width),
+                "updatedRows": len(values), "updatedColumns": width,
+                "updatedCells": sum(len(v) for v in values)}
+
+    def append(self, rng, values, insert_rows=False):
+        # مثل API: جدول از ردیف شروع range تا اولین ردیف خالی است و مقادیر بعد از آن می‌آیند
+        title, r0, c0, _, _ = parse_range(rng)
+        s = self.sheet(title)
+        last = r0
+        while last < len(s["rows"]) and any(v not in ("", None) for v in s["rows"][last]):
+            last += 1
+        if insert_rows:
+            s["rows"][last:last] = [[] for _ in values]
+            s["props"]["gridProperties"]["rowCount"] += len(values)
+        out = self.update(_a1(title, last, c0, last + 1, c0 + 1), values)
+        return {"tableRange": _a1(title, r0, c0, max(last, r0 + 1), s["props"]["gridProperties"]["columnCount"]),
+                "updates": out}
+
+    def batch_update(self, requests):
+        replies = []
+        for req in requests:
+            if "addSheet" in req:
+                p = req["addSheet"].get("properties", {})
+                g = p.get("gridProperties", {})
+                props = self.add_sheet(p.get("title", f"Sheet{len(self.sheets) + 1}"), None,
+                                       g.get("rowCount", 1000), g.get("columnCount", 26))
+                replies.append({"addSheet": {"properties": props}})
+            elif "insertDimension" in req or "deleteDimension" in req:
+                op = "insertDimension" if "insertDimension" in req else "deleteDimension"
+                r = req[op]["range"]
+                if r.get("dimension") != "ROWS":
+                    raise ApiError(400, "INVALID_ARGUMENT", "Only ROWS dimension is emulated.")
+                s = self.by_id(r["sheetId"])
+                a, b = r["startIndex"], r["endIndex"]
+                if op == "insertDimension":
+                    s["rows"][a:a] = [[] for _ in range(b - a)]
+                    s["props"]["gridProperties"]["rowCount"] += b - a
+                else:
+                    del s["rows"][a:b]
+                    grid = s["props"]["gridProperties"]
+                    grid["rowCount"] = max(grid["rowCount"] - (b - a), len(s["rows"]))
+                replies.append({})
+            else:
+                raise ApiError(400, "INVALID_ARGUMENT", f"Request not emulated: {list(req)}")
+        return replies
+
+    def dump(self):
+        return {t: s["rows"] for t, s in self.sheets.items()}
+
+# ---------------------------
+# دادهٔ ساختگی (اگر EMU_DATA نباشد)
+# ---------------------------
+def seed_tabs(rows_per_tab, days=14, seed=7):
+    rnd = random.Random(seed)
+    names = [f"Operator {i}" for i in range(60)]
+    users = [f"user{i}" + rnd.choice([".s1", ".s2", ".s3", ".flex", ""]) for i in range(60)]
+    start = datetime(2024, 1, 1)
+    base_cols = ["full_name", "date", "hour", "Start", "End", "Count", "username"]
+
+    def rows(extra=()):
+        out = [base_cols + [e for e, _ in extra]]
+        for _ in range(rows_per_tab):
+            i = rnd.randrange(len(names))
+            a = rnd.randrange(0, 50)
+            out.append([
+                names[i], (start + timedelta(days=rnd.randrange(days))).strftime("%Y-%m-%d"),
+                str(rnd.randrange(8, 22)), str(a), str(a + rnd.randrange(1, 15)),
+                str(rnd.randrange(1, 400)), users[i],
+            ] + [fn() for _, fn in extra])
+        return out
+
+    centers = ["مرکز پردازش مهرآباد", "هاب گنجه", "هاب شرق"]
+    tabs = {
+        "All_Data": [list(HEADERS)],
+        "KPI_Config": [["task_type", "base", "rotation", "effective_from"]] + [
+            [t, "300", "5", "2023-01-01"]
+            for t in ("Receive", "Locate", "Sort", "Pack_Single", "Pack_Multi", "Stock taking",
+                      "Pick", "Presort", "Pick_Larg", "Presort_Larg")
+        ],
+        "Other Work": [["Timestamp", "Email", "full_name"]],
+        "Receive": rows([("warehouse_name", lambda: rnd.choice(centers))]),
+        "Locate": rows(),
+        "Sort": rows(),
+        "Pack": rows([("count_order", lambda: str(rnd.randrange(1, 300)))]),
+        "Stock taking": rows(),
+        "Pick": rows(),
+        "Presort": rows(),
+    }
+    return tabs
+
+# ---------------------------
+# HTTP
+# ---------------------------
+class Emulator:
+    def __init__(self, workbook):
+        self.wb = workbook
+        self.calls = deque()
+        self.quota_lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def over_quota(self):
+        if EMU_429_RATE and random.random() < EMU_429_RATE:
+            return True
+        if EMU_QUOTA_PER_MINUTE <= 0:
+            return False
+        now = time.monotonic()
+        with self.quota_lock:
+            while self.calls and now - self.calls[0] > 60:
+                self.calls.popleft()
+            if len(self.calls) >= EMU_QUOTA_PER_MINUTE:
+                return True
+            self.calls.append(now)
+        return False
+
+    def dispatch(self, method, path, qs, body):
+        # /v4/spreadsheets/{id}[/values/{range}[:append] | /values:batchGet | /values:batchUpdate | :batchUpdate]
+        m = re.match(r"^/v4/spreadsheets/([^/:]+)(.*)$", path)
+        if not m:
+            raise ApiError(404, "NOT_FOUND", f"Not emulated: {path}")
+        sid, rest = m[1], m[2]
+        one = lambda k, d=None: (qs.get(k) or [d])[0]
+        render = one("valueRenderOption", "FORMATTED_VALUE")
+        major = one("majorDimension", "ROWS")
+        wb = self.wb
+        with wb.lock:
+            if rest == "" and method == "GET":
+                return "metadata", wb.metadata(sid)
+            if rest == ":batchUpdate" and method == "POST":
+                return "batchUpdate", {"spreadsheetId": sid, "replies": wb.batch_update(body.get("requests", []))}
+            if rest == "/values:batchGet" and method == "GET":
+                return "values.batchGet", {"spreadsheetId": sid,
+                                           "valueRanges": [wb.get(r, major, render) for r in qs.get("ranges", [])]}
+            if rest == "/values:batchUpdate" and method == "POST":
+                res = [wb.update(d["range"], d.get("values", [])) for d in body.get("data", [])]
+                return "values.batchUpdate", {
+                    "spreadsheetId": sid,
+                    "totalUpdatedRows": sum(r["updatedRows"] for r in res),
+                    "totalUpdatedCells": sum(r["updatedCells"] for r in res),
+                    "responses": [dict(r, spreadsheetId=sid) for r in res],
+                }
+            if rest.startswith("/values/"):
+                rng = unquote(rest[len("/values/"):])
+                if rng.endswith(":append") and method == "POST":
+                    res = wb.append(rng[:-len(":append")], body.get("values", []),
+                                    one("insertDataOption", "OVERWRITE") == "INSERT_ROWS")
+                    res["updates"]["spreadsheetId"] = sid
+                    return "values.append", dict(res, spreadsheetId=sid)
+                if method == "GET":
+                    return "values.get", wb.get(rng, major, render)
+                if method == "PUT":
+                    return "values.update", dict(wb.update(rng, body.get("values", [])), spreadsheetId=sid)
+        raise ApiError(404, "NOT_FOUND", f"Not emulated: {method} {path}")
+
+
+def make_handler(emu):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _send(self, code, payload, extra_headers=()):
+            raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            delay = EMU_LATENCY_MS + random.uniform(0, EMU_JITTER_MS) + EMU_LATENCY_PER_KB_MS * len(raw) / 1024
+            time.sleep(delay / 1000.0)
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(raw)))
+            for k, v in extra_headers:
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(raw)
+            emu.stats["bytes_out"] += len(raw)
+
+        def _error(self, code, status, message, extra_headers=()):
+            emu.stats[str(code)] += 1
+            self._send(code, {"error": {"code": code, "message": message, "status": status}}, extra_headers)
+
+        def _handle(self):
+            u = urlsplit(self.path)
+            if u.path == "/_emulator/stats":
+                return self._send(200, dict(emu.stats))
+            n = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(n) if n else b""
+            emu.stats["bytes_in"] += len(raw)
+            if len(raw) > EMU_MAX_REQUEST_BYTES:
+                return self._error(400, "INVALID_ARGUMENT",
+                                   f"Request payload size exceeds the limit: {EMU_MAX_REQUEST_BYTES} bytes.")
+            if emu.over_quota():
+                return self._error(429, "RESOURCE_EXHAUSTED",
+                                   "Quota exceeded for quota metric 'Read requests' and limit "
+                                   "'Read requests per minute per user'.", [("Retry-After", "10")])
+            try:
+                body = json.loads(raw) if raw else {}
+                kind, payload = emu.dispatch(self.command, u.path, parse_qs(u.query), body)
+            except ApiError as e:
+                return self._error(e.code, e.status, str(e))
+            except (ValueError, KeyError, TypeError) as e:
+                return self._error(400, "INVALID_ARGUMENT", str(e))
+            emu.stats[kind] += 1
+            if EMU_MAX_RESPONSE_BYTES and len(json.dumps(payload, ensure_ascii=False).encode("utf-8")) > EMU_MAX_RESPONSE_BYTES:
+                return self._error(400, "INVALID_ARGUMENT",
+                                   f"Response size exceeds the limit: {EMU_MAX_RESPONSE_BYTES} bytes.")
+            self._send(200, payload)
+
+        do_GET = do_POST = do_PUT = _handle
+
+    return Handler
+
+
+def load_workbook():
+    if EMU_DATA:
+        with open(EMU_DATA, encoding="utf-8") as f:
+            tabs = json.load(f)
+        print(f"ℹ️ Loaded {len(tabs)} tabs from {EMU_DATA}.")
+    elif EMU_SNAPSHOT:
+        root, _, ref = EMU_SNAPSHOT.partition("@")
+        store = SnapshotStore(root)
+        man = store.manifest(ref or "latest")
+        tabs = {}
+        for title, e in man["tabs"].items():
+            tabs[title] = store.get(e["sha256"])
+            if e.get("first_row"):
+                print(f"⚠️ Snapshot of '{title}' only has rows from {e['first_row']} on.")
+        tabs.setdefault("All_Data", [list(HEADERS)])
+        print(f"ℹ️ Loaded snapshot {man['id']} ({len(man['tabs'])} tabs) from {root}.")
+    else:
+        tabs = seed_tabs(EMU_SEED_ROWS)
+        print(f"ℹ️ Seeded {len(tabs)} tabs with {EMU_SEED_ROWS} rows per source tab.")
+    return Workbook(tabs)
+
+
+def serve(workbook=None, host=EMU_HOST, port=EMU_PORT):
+    emu = Emulator(workbook or load_workbook())
+    httpd = ThreadingHTTPServer((host, port), make_handler(emu))
+    httpd.daemon_threads = True
+    return httpd, emu
+
+
+if __name__ == "__main__":
+    httpd, emu = serve()
+    print(f"✅ Sheets emulator on http://{EMU_HOST}:{EMU_PORT} "
+          f"(latency {EMU_LATENCY_MS:g}+{EMU_JITTER_MS:g} ms, quota {EMU_QUOTA_PER_MINUTE}/min).")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if EMU_SAVE_PATH:
+            with open(EMU_SAVE_PATH, "w", encoding="utf-8") as f:
+                json.dump(emu.wb.dump(), f, ensure_ascii=False)
+            print(f"ℹ️ Saved workbook to {EMU_SAVE_PATH}.")
+        print(f"ℹ️ Calls: {dict(emu.stats)}")
@@ -1,15 +1,38 @@
 # web.py
 import os
+import re
+import json
+import fcntl
+import shutil
+import socket
+import math
 import time
+import bisect
+import sqlite3
+import threading
 import subprocess
-from flask import Flask, jsonify, request
+from collections import defaultdict
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
+
+from common import HEADERS, RECORDS_PATH, LOCK_PATH, norm_name, norm_task, base_task
 
 app = Flask(__name__)
 
 RUN_TOKEN = os.getenv("RUN_TOKEN", "")
-LOCK_PATH = "/tmp/all_data.lock"
 MAX_RUN_SECONDS = int(os.getenv("MAX_RUN_SECONDS", "1200"))          # 20 min
 LOCK_STALE_SECONDS = int(os.getenv("LOCK_STALE_SECONDS", "7200"))    # 2h
+LOCK_HEARTBEAT_SECONDS = int(os.getenv("LOCK_HEARTBEAT_SECONDS", "15"))
+RUN_HISTORY_DB = os.getenv("RUN_HISTORY_DB", "/tmp/all_data_runs.sqlite")
+RUN_DIR = os.getenv("RUN_DIR", "/tmp")
+RUN_FILES_KEEP = int(os.getenv("RUN_FILES_KEEP", "50"))              # per-run files kept (0 = all)
+RUN_STALE_CHECK_SECONDS = float(os.getenv("RUN_STALE_CHECK_SECONDS", "5"))
+SSE_POLL_SECONDS = float(os.getenv("SSE_POLL_SECONDS", "0.5"))
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+SCHEDULE_SECONDS = int(os.getenv("SCHEDULE_SECONDS", "0"))           # 0 = external cron only
+PENDING_PATH = os.getenv("PENDING_PATH", "/tmp/all_data.pending")
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", "/tmp/all_data.scheduler.lock")
+PROFILE_RUNS = os.getenv("PROFILE_RUNS", "0") == "1"                # profile every run
+PROFILE_FILES = {"pstats": ("run.pstats", "application/octet-stream"), "alloc": ("alloc.txt", "text/plain")}
 
 
 def authorized(req) -> bool:
@@ -19,76 +42,762 @@ def authorized(req) -> bool:
     return auth == f"Bearer {RUN_TOKEN}"
 
 
-def lock_active() -> bool:
-    if not os.path.exists(LOCK_PATH):
+def _pid_alive(pid) -> bool:
+    if not pid:
         return False
     try:
-        age = time.time() - os.path.getmtime(LOCK_PATH)
-        if age > LOCK_STALE_SECONDS:
-            os.remove(LOCK_PATH)
-            return False
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
         return True
-    except Exception:
+    except (OSError, ValueError):
+        return False
+    try:
+        # an orphaned child that exited stays a zombie until reaped; it holds nothing
+        with open(f"/proc/{int(pid)}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+class RunLock:
+    """
+    Advisory flock() on LOCK_PATH, held for the whole pipeline run.
+    The kernel drops it when the holder dies, so there is no check-then-write
+    window and no stale file to clean up. The file body records the owner
+    (pid, host, started_at, child_pid) and a heartbeat refreshed while the run
+    is alive. The pipeline child inherits the locked fd, so the lock outlives
+    a worker that dies mid-run until the child exits too.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._stop = threading.Event()
+        self._beat = None
+        self._info = {}
+        # heartbeat thread و annotate() هم‌زمان _info و بدنهٔ فایل را می‌نویسند
+        self._info_lock = threading.Lock()
+
+    def _write(self) -> None:
+        with self._info_lock:
+            if self._fd is None:
+                return
+            self._info["heartbeat_at"] = time.time()
+            data = json.dumps(self._info).encode("utf-8")
+            os.pwrite(self._fd, data, 0)
+            os.ftruncate(self._fd, len(data))
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(LOCK_HEARTBEAT_SECONDS):
+            try:
+                self._write()
+            except OSError:
+                pass
+
+    def acquire(self) -> bool:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        prev = self.holder(fd)
+        if prev and prev.get("pid"):
+            print(f"ℹ️ Previous lock holder pid={prev.get('pid')} on {prev.get('host')} is gone; taking over.")
+
+        with self._info_lock:
+            self._fd = fd
+            self._info = {"pid": os.getpid(), "host": socket.gethostname(), "started_at": time.time()}
+        self._write()
+        self._stop.clear()
+        self._beat = threading.Thread(target=self._heartbeat, name="lock-heartbeat", daemon=True)
+        self._beat.start()
         return True
 
+    def fileno(self):
+        return self._fd
+
+    def annotate(self, **fields) -> None:
+        with self._info_lock:
+            if self._fd is None:
+                return
+            self._info.update(fields)
+        self._write()
+
+    def release(self) -> None:
+        with self._info_lock:
+            fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        self._stop.set()
+        if self._beat is not None:
+            self._beat.join(timeout=5)
+        try:
+            os.ftruncate(fd, 0)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def holder(self, fd=None) -> dict:
+        try:
+            if fd is None:
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+            else:
+                raw = os.pread(fd, 4096, 0)
+            return json.loads(raw) if raw.strip() else {}
+        except (OSError, ValueError):
+            return {}
+
+    def active(self) -> bool:
+        """
+        Read-only probe from the owner recorded in the file: held while its pid or
+        child_pid is alive (release() empties the file). It never takes the flock,
+        so it cannot make a concurrent acquire() fail.
+        """
+        info = self.holder()
+        if not info:
+            return False
+        if info.get("host") and info["host"] != socket.gethostname():
+            # pid از میزبان دیگر قابل بررسی نیست
+            return time.time() - float(info.get("heartbeat_at") or 0) <= LOCK_STALE_SECONDS
+        return _pid_alive(info.get("pid")) or _pid_alive(info.get("child_pid"))
+
+    def status(self) -> dict:
+        if not self.active():
+            return {"held": False}
+        info = self.holder()
+        age = time.time() - float(info.get("heartbeat_at") or 0)
+        info.update({"held": True, "heartbeat_age_s": round(age, 1), "stale": age > LOCK_STALE_SECONDS})
+        return info
+
+
+RUN_LOCK = RunLock(LOCK_PATH)
+
+
+def _perf_float(x):
+    s = str(x or "").strip().rstrip("%")
+    try:
+        return float(s) if s else None
+    except ValueError:
+        return None
+
+
+class PerfIndex:
+    """
+    In-memory index over RECORDS_PATH (JSON line per All_Data row).
+    refresh() only reads bytes appended since the previous call. A later line
+    with the same (name, task, date, hour) replaces the earlier record in place
+    (re-computed rows, e.g. after a KPI backfill). The task is keyed without
+    _Larg, so a row relabelled by a Larg override replaces its old label.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._ino = None
+        self._offset = 0
+        self.count = 0
+        self.by_key = {}                   # (name, task without _Larg, date, hour) -> record
+        self.by_name = defaultdict(list)   # norm_name -> [record]
+        self.by_date = defaultdict(list)   # "YYYY-MM-DD" -> [record]
+        self._dates = []                   # sorted keys of by_date
+
+    def refresh(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return
+            if st.st_ino != self._ino or st.st_size < self._offset:
+                self._reset()
+                self._ino = st.st_ino
+            if st.st_size == self._offset:
+                return
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                chunk = f.read()
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                return
+            new_date = False
+            for line in chunk[:end].splitlines():
+                try:
+                    rec = dict(zip(HEADERS, json.loads(line)))
+                except ValueError:
+                    continue
+                name_key = norm_name(rec.get("full_name"))
+                if not name_key:
+                    continue
+                d = rec.get("date") or ""
+                key = (name_key, base_task(norm_task(rec.get("task_type"))), d, str(rec.get("hour") or ""))
+                if key in self.by_key:
+                    self.by_key[key].update(rec)
+                    continue
+                self.by_key[key] = rec
+                if d not in self.by_date:
+                    new_date = True
+                self.by_name[name_key].append(rec)
+                self.by_date[d].append(rec)
+                self.count += 1
+            if new_date:
+                self._dates = sorted(self.by_date)
+            self._offset += end + 1
+
+    def query(self, name="", date_from="", date_to="", task="", shift=""):
+        self.refresh()
+        with self._lock:
+            if name:
+                candidates = list(self.by_name.get(norm_name(name), ()))
+            else:
+                lo = bisect.bisect_left(self._dates, date_from) if date_from else 0
+                hi = bisect.bisect_right(self._dates, date_to) if date_to else len(self._dates)
+                candidates = [r for d in self._dates[lo:hi] for r in self.by_date[d]]
+        task_key = norm_task(task) if task else ""
+        shift_key = shift.strip().lower()
+        out = []
+        for r in candidates:
+            d = r.get("date") or ""
+            if date_from and d < date_from:
+                continue
+            if date_to and d > date_to:
+                continue
+            if task_key and norm_task(r.get("task_type")) != task_key:
+                continue
+            if shift_key and (r.get("Shift") or "").lower() != shift_key:
+                continue
+            out.append(r)
+        out.sort(key=lambda r: (r.get("date") or "", _perf_float(r.get("hour")) or 0, r.get("task_type") or ""))
+        return out
+
+
+PERF_INDEX = PerfIndex(RECORDS_PATH)
+
 
-def acquire_lock() -> None:
-    with open(LOCK_PATH, "w", encoding="utf-8") as f:
-        f.write(str(time.time()))
+def summarize(rows) -> dict:
+    qty = occ = perf_occ = wo_x = wi_x = 0.0
+    for r in rows:
+        o = _perf_float(r.get("occupied_hours")) or 0.0
+        qty += _perf_float(r.get("quantity")) or 0.0
+        occ += o
+        p_wo = _perf_float(r.get("performance_without_rotation"))
+        p_wi = _perf_float(r.get("performance_with_rotation"))
+        if p_wo is not None and p_wi is not None and o > 0:
+            perf_occ += o
+            wo_x += p_wo * o
+            wi_x += p_wi * o
+    return {
+        "rows": len(rows),
+        "quantity": qty,
+        "occupied_minutes": occ,
+        "performance_without_rotation": round(wo_x / perf_occ, 1) if perf_occ else None,
+        "performance_with_rotation": round(wi_x / perf_occ, 1) if perf_occ else None,
+    }
 
 
-def release_lock() -> None:
+def _db() -> sqlite3.Connection:
+    conn = sqlite3.connect(RUN_HISTORY_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at  REAL NOT NULL,
+            ended_at    REAL,
+            duration_s  REAL,
+            status      TEXT NOT NULL,
+            returncode  INTEGER,
+            message     TEXT,
+            stats       TEXT,
+            trigger     TEXT
+        )
+    """)
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(runs)")}
+    if "trigger" not in cols:
+        conn.execute("ALTER TABLE runs ADD COLUMN trigger TEXT")
+    return conn
+
+
+def history_start(trigger: str = "api") -> int:
+    with _db() as conn:
+        cur = conn.execute(
+            "INSERT INTO runs (started_at, status, trigger) VALUES (?, 'running', ?)",
+            (time.time(), trigger),
+        )
+        return cur.lastrowid
+
+
+def history_finish(run_id: int, status: str, returncode, message: str, stats_path: str) -> None:
+    stats = None
     try:
-        if os.path.exists(LOCK_PATH):
-            os.remove(LOCK_PATH)
-    except Exception:
+        with open(stats_path, encoding="utf-8") as f:
+            stats = f.read()
+        os.remove(stats_path)
+    except OSError:
         pass
+    ended = time.time()
+    with _db() as conn:
+        conn.execute(
+            "UPDATE runs SET ended_at = ?, duration_s = ? - started_at, status = ?, "
+            "returncode = ?, message = ?, stats = ? WHERE id = ?",
+            (ended, ended, status, returncode, message, stats, run_id),
+        )
+    prune_run_files()
 
 
-@app.get("/")
-def home():
-    return "OK"
+def fail_stale_runs() -> int:
+    """
+    Marks runs left 'running' by a worker that died as failed. Only the run whose
+    id the live lock holder recorded is still running; while a holder has not
+    recorded its run_id yet, nothing is touched. -> runs marked
+    """
+    holder = RUN_LOCK.holder() if RUN_LOCK.active() else {}
+    if holder and not holder.get("run_id"):
+        return 0
+    now = time.time()
+    with _db() as conn:
+        cur = conn.execute(
+            "UPDATE runs SET ended_at = ?, duration_s = ? - started_at, status = 'failed', "
+            "message = ? WHERE status = 'running' AND id IS NOT ?",
+            (now, now, "❌ Run abandoned (worker exited before finishing)", holder.get("run_id")),
+        )
+        return cur.rowcount
 
 
-@app.get("/health")
-def health():
-    return jsonify({"status": "ok", "lock": lock_active()}), 200
+RUN_FILE_RE = re.compile(r"^all_data_run_(\d+)\.")
 
 
-@app.post("/run")
-def run():
-    if not authorized(request):
-        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+def run_file(run_id: int, suffix: str) -> str:
+    return os.path.join(RUN_DIR, f"all_data_run_{run_id}.{suffix}")
 
-    if lock_active():
-        return jsonify({"status": "error", "message": "Already running"}), 409
 
-    acquire_lock()
+def prune_run_files() -> None:
+    """Keeps the per-run files (events, profile, leftover stats) of the newest RUN_FILES_KEEP runs."""
+    if RUN_FILES_KEEP <= 0:
+        return
+    by_run = defaultdict(list)
     try:
-        p = subprocess.run(
+        names = os.listdir(RUN_DIR)
+    except OSError:
+        return
+    for name in names:
+        m = RUN_FILE_RE.match(name)
+        if m:
+            by_run[int(m.group(1))].append(name)
+    for run_id in sorted(by_run)[:-RUN_FILES_KEEP]:
+        if run_status(run_id) == "running":
+            continue
+        for name in by_run[run_id]:
+            path = os.path.join(RUN_DIR, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def run_status(run_id: int):
+    with _db() as conn:
+        row = conn.execute("SELECT status FROM runs WHERE id = ?", (run_id,)).fetchone()
+    return row["status"] if row else None
+
+
+def _run_row(row) -> dict:
+    d = dict(row)
+    d["stats"] = json.loads(d["stats"]) if d.get("stats") else None
+    return d
+
+
+def percentiles(values, ps=(50, 90, 99)) -> dict:
+    vals = sorted(v for v in values if v is not None)
+    if not vals:
+        return {}
+    out = {}
+    for p in ps:
+        k = max(0, min(len(vals) - 1, math.ceil(p / 100.0 * len(vals)) - 1))
+        out[f"p{p}"] = round(vals[k], 3)
+    return out
+
+
+def execute_run(trigger: str, profile: bool = False):
+    """
+    Runs All_Data.py while RUN_LOCK is held by the caller; always releases it.
+    Returns (payload, http_code).
+    """
+    try:
+        run_id = history_start(trigger)
+    except Exception as e:
+        RUN_LOCK.release()
+        return {"status": "error", "message": f"❌ Run history: {e}"}, 500
+    RUN_LOCK.annotate(run_id=run_id)
+    stats_path = run_file(run_id, "json")
+    status, returncode, msg = "error", None, ""
+    try:
+        env = os.environ.copy()
+        env["RUN_STATS_PATH"] = stats_path
+        env["RUN_EVENTS_PATH"] = run_file(run_id, "events.jsonl")
+        profile_dir = run_file(run_id, "profile")
+        if profile or PROFILE_RUNS:
+            env["RUN_PROFILE_DIR"] = profile_dir
+        # the child inherits the locked fd: the lock stays held while it runs,
+        # even if this worker is killed first
+        p = subprocess.Popen(
             ["python", "All_Data.py"],
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=MAX_RUN_SECONDS,
-            env=os.environ.copy(),
+            env=env,
+            pass_fds=(RUN_LOCK.fileno(),),
         )
+        RUN_LOCK.annotate(child_pid=p.pid)
+        try:
+            out, err = p.communicate(timeout=MAX_RUN_SECONDS)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise
+
+        PERF_INDEX.refresh()
 
-        out = (p.stdout or "").strip()
-        err = (p.stderr or "").strip()
+        out = (out or "").strip()
+        err = (err or "").strip()
         ok = (p.returncode == 0)
         msg = out.splitlines()[-1] if out else ("✅ Done" if ok else "❌ Failed")
+        status, returncode = ("ok" if ok else "error"), p.returncode
+        try:
+            with open(stats_path, encoding="utf-8") as f:
+                errors = json.load(f).get("errors") or {}
+        except (OSError, ValueError):
+            errors = {}
 
-        return jsonify({
+        payload = {
             "status": "ok" if ok else "error",
+            "run_id": run_id,
+            "trigger": trigger,
             "message": msg,
             "returncode": p.returncode,
             "stdout_tail": out[-2000:] if out else "",
-            "stderr_tail": err[-2000:] if err else ""
-        }), (200 if ok else 500)
+            "stderr_tail": err[-2000:] if err else "",
+            "errors": errors,
+        }
+        if "RUN_PROFILE_DIR" in env:
+            payload["profile"] = profile_summary(run_id, top=10)
+        return payload, (200 if ok else 500)
 
     except subprocess.TimeoutExpired:
-        return jsonify({"status": "error", "message": "⏱ Timeout"}), 504
+        status, msg = "timeout", "⏱ Timeout"
+        return {"status": "error", "run_id": run_id, "message": msg}, 504
     except Exception as e:
-        return jsonify({"status": "error", "message": f"❌ {e}"}), 500
+        msg = f"❌ {e}"
+        return {"status": "error", "run_id": run_id, "message": msg}, 500
     finally:
-        release_lock()
+        try:
+            history_finish(run_id, status, returncode, msg, stats_path)
+        except Exception as e:
+            print(f"❌ Run history error: {e}")
+        RUN_LOCK.release()
+
+
+# ---------------------------
+# Trigger coalescing: a trigger that finds a run in progress leaves PENDING_PATH
+# behind; whoever releases the lock next runs exactly one follow-up for all of them.
+# ---------------------------
+def request_followup() -> None:
+    with open(PENDING_PATH, "a", encoding="utf-8"):
+        pass
+
+
+def take_followup() -> bool:
+    try:
+        os.remove(PENDING_PATH)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def trigger_run(trigger: str, profile: bool = False):
+    """(payload, code) of the run, or None if it was coalesced into a follow-up."""
+    if not RUN_LOCK.acquire():
+        request_followup()
+        # the holder may have finished between the two calls
+        if not RUN_LOCK.acquire():
+            return None
+        take_followup()
+    return execute_run(trigger, profile)
+
+
+def drain_followups() -> None:
+    while os.path.exists(PENDING_PATH) and RUN_LOCK.acquire():
+        if not take_followup():
+            RUN_LOCK.release()
+            return
+        execute_run("followup")
+
+
+def last_success_at():
+    with _db() as conn:
+        row = conn.execute("SELECT MAX(ended_at) AS t FROM runs WHERE status = 'ok'").fetchone()
+    return row["t"] if row else None
+
+
+def freshness() -> dict:
+    t = last_success_at()
+    return {
+        "last_success_at": t,
+        "age_s": round(time.time() - t, 1) if t else None,
+        "followup_pending": os.path.exists(PENDING_PATH),
+        "schedule_seconds": SCHEDULE_SECONDS,
+    }
+
+
+def profile_summary(run_id: int, top: int = 0):
+    try:
+        with open(os.path.join(run_file(run_id, "profile"), "summary.json"), encoding="utf-8") as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if top:
+        summary["top_cumulative"] = summary.get("top_cumulative", [])[:top]
+        summary["top_tottime"] = summary.get("top_tottime", [])[:top]
+    return summary
+
+
+def _scheduler_loop() -> None:
+    """
+    One leader across gunicorn workers (flock on SCHEDULER_LOCK_PATH, held for
+    the worker's lifetime); the others keep retrying so a new leader takes over.
+    """
+    leader_fd = None
+    while True:
+        if leader_fd is None:
+            fd = os.open(SCHEDULER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                leader_fd = fd
+            except BlockingIOError:
+                os.close(fd)
+        if leader_fd is not None:
+            try:
+                trigger_run("schedule")
+                drain_followups()
+            except Exception as e:
+                print(f"❌ Scheduled run error: {e}")
+        time.sleep(SCHEDULE_SECONDS)
+
+
+try:
+    if fail_stale_runs():
+        print("ℹ️ Marked runs abandoned by a dead worker as failed.")
+    prune_run_files()
+except Exception as e:
+    print(f"❌ Run history cleanup error: {e}")
+
+if SCHEDULE_SECONDS > 0:
+    threading.Thread(target=_scheduler_loop, name="scheduler", daemon=True).start()
+
+
+@app.get("/")
+def home():
+    return "OK"
+
+
+@app.get("/health")
+def health():
+    return jsonify({"status": "ok", "lock": RUN_LOCK.status(), "freshness": freshness()}), 200
+
+
+@app.post("/run")
+def run():
+    if not authorized(request):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    result = trigger_run("api", profile=request.args.get("profile") == "1")
+    threading.Thread(target=drain_followups, name="followup", daemon=True).start()
+    if result is None:
+        return jsonify({
+            "status": "queued",
+            "message": "Already running; coalesced into one follow-up run",
+            "lock": RUN_LOCK.status(),
+        }), 202
+    payload, code = result
+    return jsonify(payload), code
+
+
+@app.get("/runs")
+def runs():
+    if not authorized(request):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    try:
+        limit = max(1, min(int(request.args.get("limit", "50")), 1000))
+    except ValueError:
+        limit = 50
+    with _db() as conn:
+        rows = [_run_row(r) for r in conn.execute(
+            "SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,)
+        )]
+
+    ok_runs = [r for r in rows if r["status"] == "ok"]
+    stage_times = defaultdict(list)
+    emitted = []
+    for r in ok_runs:
+        st = r["stats"] or {}
+        for stage, secs in (st.get("stages") or {}).items():
+            stage_times[stage].append(secs)
+        emitted.append(sum((st.get("rows_emitted") or {}).values()))
+
+    return jsonify({
+        "status": "ok",
+        "summary": {
+            "runs": len(rows),
+            "by_status": {s: sum(1 for r in rows if r["status"] == s) for s in {r["status"] for r in rows}},
+            "duration_s": percentiles([r["duration_s"] for r in ok_runs]),
+            "rows_emitted": percentiles(emitted),
+            "stages_s": {k: percentiles(v) for k, v in stage_times.items()},
+        },
+        "runs": rows,
+    }), 200
+
+
+def _sse_stream(run_id: int, skip: int):
+    """Streams the run's events; ends once the run is finished, failed as stale, or gone."""
+    path = run_file(run_id, "events.jsonl")
+    offset, seq = 0, 0
+    last_sent = last_check = time.monotonic()
+    while True:
+        status = run_status(run_id)
+        if status == "running" and time.monotonic() - last_check >= RUN_STALE_CHECK_SECONDS:
+            last_check = time.monotonic()
+            if fail_stale_runs():
+                status = run_status(run_id)
+        finished = status != "running"
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read()
+        except OSError:
+            chunk = b""
+        end = chunk.rfind(b"\n")
+        if end >= 0:
+            offset += end + 1
+            for line in chunk[:end].splitlines():
+                seq += 1
+                if seq <= skip:
+                    continue
+                try:
+                    kind = json.loads(line).get("event", "message")
+                except ValueError:
+                    continue
+                yield f"id: {seq}\nevent: {kind}\ndata: {line.decode('utf-8')}\n\n"
+                last_sent = time.monotonic()
+        if finished and end < 0:
+            yield f"event: end\ndata: {json.dumps({'run_id': run_id, 'status': run_status(run_id)})}\n\n"
+            return
+        if time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+        time.sleep(SSE_POLL_SECONDS)
+
+
+@app.get("/runs/<run_ref>/events")
+def run_events(run_ref: str):
+    """
+    Server-sent events for one run. `run_ref` is a run id or "current"
+    (the run holding the lock). Reconnects resume after Last-Event-ID.
+    """
+    if not authorized(request):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    if run_ref == "current":
+        run_id = RUN_LOCK.status().get("run_id")
+        if not run_id:
+            return jsonify({"status": "error", "message": "No run in progress"}), 404
+    else:
+        try:
+            run_id = int(run_ref)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Bad run id"}), 400
+    if run_status(run_id) is None:
+        return jsonify({"status": "error", "message": "Not found"}), 404
+
+    try:
+        skip = int(request.headers.get("Last-Event-ID") or 0)
+    except ValueError:
+        skip = 0
+    return Response(
+        stream_with_context(_sse_stream(run_id, skip)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/runs/<int:run_id>/profile")
+def run_profile(run_id: int):
+    """JSON summary, or ?file=pstats|alloc to download the raw artifacts."""
+    if not authorized(request):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    which = request.args.get("file")
+    if which:
+        if which not in PROFILE_FILES:
+            return jsonify({"status": "error", "message": "file must be pstats or alloc"}), 400
+        name, mimetype = PROFILE_FILES[which]
+        path = os.path.join(run_file(run_id, "profile"), name)
+        if not os.path.exists(path):
+            return jsonify({"status": "error", "message": "Not found"}), 404
+        return send_file(path, mimetype=mimetype, as_attachment=True,
+                         download_name=f"run_{run_id}_{name}")
+
+    summary = profile_summary(run_id)
+    if summary is None:
+        return jsonify({"status": "error", "message": "No profile for this run"}), 404
+    return jsonify({"status": "ok", "run_id": run_id, "profile": summary}), 200
+
+
+@app.get("/runs/<int:run_id>")
+def run_detail(run_id: int):
+    if not authorized(request):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    with _db() as conn:
+        row = conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+    if row is None:
+        return jsonify({"status": "error", "message": "Not found"}), 404
+    return jsonify({"status": "ok", "run": _run_row(row)}), 200
+
+
+@app.get("/perf")
+def perf():
+    if not authorized(request):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    args = request.args
+    name = (args.get("name") or "").strip()
+    date_from = (args.get("from") or "").strip()
+    date_to = (args.get("to") or "").strip()
+    if not name and not (date_from or date_to):
+        return jsonify({"status": "error", "message": "name or from/to is required"}), 400
+
+    t0 = time.perf_counter()
+    rows = PERF_INDEX.query(
+        name=name,
+        date_from=date_from,
+        date_to=date_to,
+        task=(args.get("task") or "").strip(),
+        shift=(args.get("shift") or "").strip(),
+    )
+    return jsonify({
+        "status": "ok",
+        "summary": summarize(rows),
+        "rows": rows,
+        "indexed": PERF_INDEX.count,
+        "took_ms": round((time.perf_counter() - t0) * 1000, 2),
+    }), 200